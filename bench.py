@@ -0,0 +1,427 @@
+"""Бенчмарк бота на синтетической выгрузке: загрузка таблицы, поиск ММ в сообщениях, наклейки.
+
+    python bench.py                                   # 1k, 10k и 100k строк
+    python bench.py --sizes 1000 10000 --save old.json
+    python bench.py --sizes 1000 10000 --compare old.json
+
+Бот работает в отдельной временной папке со своим config.json; Telegram
+заменён заглушками, поэтому сеть и токен не нужны. Сгенерированные выгрузки
+кешируются в --data-dir, чтобы повторные прогоны сравнивали одинаковые данные.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO)
+
+from ingest import DEFAULT_BRANCHES, REPORT_COLUMNS, REQUIRED_COLUMNS  # noqa: E402
+
+# === СИНТЕТИЧЕСКАЯ ВЫГРУЗКА ===
+
+NAME_ROOTS = [
+    "Ромашк", "Берёзк", "Ажур", "Лазурь", "Солнечн", "Звёздн", "Калинк", "Рябинк", "Сосн", "Кедр",
+    "Мир", "Уют", "Радуг", "Весн", "Заря", "Волг", "Урал", "Агидель", "Тулпар", "Нур",
+    "Алтын", "Байкал", "Янтар", "Изумруд", "Жемчужин", "Светлан", "Дружб", "Удач", "Семейн", "Домашн",
+    "Городск", "Сельск", "Северн", "Южн", "Восточн", "Западн", "Центральн", "Нов", "Молодёжн", "Юбилейн",
+]
+NAME_ENDINGS = ["ая", "ый", "ое", "а", "ка", "ушка", "ик", "ино", "ово", "ье"]
+DISTRICTS = [
+    "", "", "", "центр", "юг", "плаза", "сити", "на Ленина", "на Гагарина", "Черниковка",
+    "Сипайлово", "Дёма", "Зелёная роща", "Инорс", "Шакша", "Затон",
+]
+SURNAMES = [
+    "Иванов", "Петров", "Сидоров", "Кузнецов", "Смирнов", "Попов", "Васильев", "Соколов", "Михайлов",
+    "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров", "Павлов",
+    "Козлов", "Степанов", "Николаев", "Орлов", "Андреев", "Макаров", "Никитин", "Захаров", "Зайцев",
+    "Соловьёв", "Борисов", "Яковлев", "Гарипов", "Хабибуллин", "Валиев", "Шарипов", "Галиев",
+]
+INITIALS = "АБВГДЕИКЛМНОПРСТФЮЯ"
+STREETS = ["Ленина", "Гагарина", "Мира", "Первомайская", "Комсомольская", "Октября", "Победы", "Российская"]
+DEVICES = [
+    "Стационарный сканер ШК 2D (сканирует QR)",
+    "Ручной сканер ШК 2D (сканирует QR)",
+    "Фискальный регистратор",
+    "Весы электронные с печатью этикеток",
+    "Терминал сбора данных",
+    "Принтер этикеток",
+    "ИБП 1500 ВА",
+    "Системный блок кассы",
+]
+CHATTER = [
+    "привет всем", "у нас опять не работает касса", "кто сегодня на смене", "спасибо",
+    "перезагрузили, заработало", "когда приедет техник", "скиньте инструкцию", "ок",
+    "сканер не читает штрихкод", "принтер не печатает ценники", "добрый день коллеги",
+]
+
+COLUMNS = [
+    "Магазин", "Код", "Статус", "Тип", "ФИО системотехника", "Телефон системотехника", "Филиал",
+    "Формат", "Дата открытия", "Дата закрытия", "Email", "Полный адрес", "Регион", "Площадь",
+]
+assert {c.lower() for c in COLUMNS} >= set(REQUIRED_COLUMNS + REPORT_COLUMNS)
+
+
+def shop_name(rng):
+    name = rng.choice(NAME_ROOTS) + rng.choice(NAME_ENDINGS)
+    district = rng.choice(DISTRICTS)
+    if district:
+        name += " " + district
+    if rng.random() < 0.3:
+        name += f" {rng.randint(1, 300)}"
+    return name
+
+
+def generate_rows(n, seed):
+    """Строки выгрузки с колонками COLUMNS; примерно треть — чужие филиалы"""
+    rng = random.Random(seed)
+    techs = [
+        (f"{rng.choice(SURNAMES)} {rng.choice(INITIALS)}.{rng.choice(INITIALS)}.", 79170000000 + i)
+        for i in range(max(5, n // 40))
+    ]
+    branches = DEFAULT_BRANCHES + ["Казань", "Самара"]
+    rows = []
+    for i in range(n):
+        tech, phone = rng.choice(techs)
+        closed = rng.random() < 0.1
+        rows.append([
+            shop_name(rng),
+            100000 + i,
+            "Закрыт" if closed else "Открыт",
+            rng.choice(["ММ", "МК", "МД"]),
+            tech,
+            phone,
+            branches[0] if i % 3 == 0 else rng.choice(branches),
+            rng.choice(["Дрогери", "Магнит у дома", "Семейный", None]),
+            f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.20{rng.randint(10, 24)}",
+            "31.12.2024" if closed else None,
+            f"mm{100000 + i}@example.ru",
+            f"г. Уфа, ул. {rng.choice(STREETS)}, {rng.randint(1, 150)}",
+            "Башкортостан",
+            rng.randint(200, 1500),
+        ])
+    return rows
+
+
+def modified_rows(rows, seed):
+    """Следующая выгрузка: ~1% изменённых статусов, ~0.5% переименованных,
+    ~0.5% удалённых и ~0.5% новых ММ"""
+    rng = random.Random(seed + 1)
+    rows = [r[:] for r in rows]
+    for r in rng.sample(rows, max(1, len(rows) // 100)):
+        r[2] = "Закрыт" if r[2] == "Открыт" else "Открыт"
+    for r in rng.sample(rows, max(1, len(rows) // 200)):
+        r[0] = shop_name(rng)
+    for i in sorted(rng.sample(range(len(rows)), max(1, len(rows) // 200)), reverse=True):
+        del rows[i]
+    added = generate_rows(max(1, len(rows) // 200), seed + 2)
+    for i, r in enumerate(added):
+        r[1] = 900000 + i
+    return rows + added
+
+
+def write_export(path, rows):
+    pd.DataFrame(rows, columns=COLUMNS).to_excel(path, index=False)
+
+
+def cached_export(data_dir, name, make_rows):
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        print(f"  генерирую {name}...", flush=True)
+        write_export(path, make_rows())
+    return path
+
+
+def message_corpus(records, n, seed):
+    """Сообщения чата: болтовня, названия ММ во фразах, вопросы, опечатки, несколько ММ сразу"""
+    rng = random.Random(seed)
+    names = [r.shop for r in records]
+
+    def typo(word):
+        if len(word) < 5:
+            return word
+        i = rng.randrange(1, len(word) - 1)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+    kinds = [
+        (0.45, lambda: rng.choice(CHATTER)),
+        (0.25, lambda: f"{rng.choice(CHATTER)} в {rng.choice(names)}"),
+        (0.10, lambda: f"чей {rng.choice(names).split()[0]}"),
+        (0.08, lambda: f"{rng.choice(names)} инфо"),
+        (0.07, lambda: f"кто техник {typo(rng.choice(names))}"),
+        (0.05, lambda: f"{rng.choice(names)} и {rng.choice(names)} не работают кассы"),
+    ]
+    messages = []
+    for _ in range(n):
+        x = rng.random()
+        for weight, make in kinds:
+            x -= weight
+            if x <= 0:
+                break
+        messages.append(make())
+    return messages
+
+
+# === ЗАГЛУШКИ TELEGRAM ===
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def stub_update(text=None, chat_id=-100, document=None):
+    message = SimpleNamespace(
+        text=text, document=document, reply_to_message=None,
+        reply_text=_noop, reply_document=_noop,
+    )
+    return SimpleNamespace(
+        message=message,
+        effective_message=message,
+        effective_user=SimpleNamespace(id=1, full_name="bench"),
+        effective_chat=SimpleNamespace(id=chat_id, title="bench"),
+    )
+
+
+def stub_document(path):
+    async def download_to_drive(dest):
+        shutil.copyfile(path, dest)
+
+    async def get_file():
+        return SimpleNamespace(download_to_drive=download_to_drive)
+
+    return SimpleNamespace(file_name=os.path.basename(path), get_file=get_file)
+
+
+STUB_CONTEXT = SimpleNamespace(bot=SimpleNamespace(username="mm_bot", id=999), args=[])
+
+
+# === ЗАМЕРЫ ===
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def timed(fn, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn(*args)
+        return time.perf_counter() - start, result
+
+
+def reset_storage(main):
+    for name in (main.SNAPSHOT_FILE, main.DB_FILE):
+        for suffix in ("", "-wal", "-shm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(name + suffix)
+    main.current_table = None
+    if main.shop_db is not None:
+        main.shop_db = main.ShopDatabase(main.DB_FILE)
+
+
+def check_indexes(main, shops):
+    """Индексы, обновлённые по разнице выгрузок, совпадают с построенными заново.
+
+    Позиции ММ в обновлённой таблице и в новой сборке разные, поэтому
+    списки сравниваются по ключам ММ (код, номер повтора).
+    """
+    live = [pos for pos, rec in enumerate(shops.records) if rec is not None]
+    key_of = {pos: key for key, pos in shops.keys.items()}
+    fresh_key = [key_of[pos] for pos in live]
+    records = [shops.records[pos] for pos in live]
+
+    def by_key(postings, keys):
+        return {k: sorted(keys[p] for p in rows) for k, rows in postings.items()}
+
+    fresh = main.MatchIndex([rec.shop for rec in records])
+    for name in ("full", "words"):
+        assert by_key(getattr(shops.index, name), key_of) == by_key(getattr(fresh, name), fresh_key), name
+    assert shops.index.lengths == fresh.lengths, "lengths"
+
+    fresh = main.build_field_index(records)
+    for name in ("codes", "techs", "phones"):
+        assert by_key(getattr(shops.fields, name), key_of) == by_key(getattr(fresh, name), fresh_key), name
+
+    def fuzzy_terms(index, keys):
+        terms = {
+            (index.terms[t], index.full[t]): sorted(keys[p] for p in rows)
+            for t, rows in index.positions.items()
+        }
+        grams = {
+            g: sorted((index.terms[t], index.full[t]) for t in ids)
+            for g, ids in index.grams.items()
+        }
+        return terms, grams
+
+    fresh = main.FuzzyIndex(enumerate(rec.shop for rec in records))
+    assert fuzzy_terms(shops.fuzzy, key_of) == fuzzy_terms(fresh, fresh_key), "fuzzy"
+    assert len(shops.fuzzy.terms) == len(fresh.terms), "fuzzy: мёртвые термины"
+    assert shops.fuzzy.lengths == fresh.lengths, "fuzzy lengths"
+
+
+def bench_size(main, data_dir, size, args, results):
+    base = cached_export(data_dir, f"export_{size}_{args.seed}.xlsx", lambda: generate_rows(size, args.seed))
+    update = cached_export(
+        data_dir, f"export_{size}_{args.seed}_next2.xlsx",
+        lambda: modified_rows(generate_rows(size, args.seed), args.seed),
+    )
+
+    shutil.copyfile(base, main.DATA_FILE)
+    reset_storage(main)
+    results[f"ingest/{size}/cold_s"], _ = timed(main.load_table)
+    main.current_table = None
+    results[f"ingest/{size}/warm_s"], _ = timed(main.load_table)
+    if main.shop_db is None:
+        # индексы из снимка таблицы совпадают с собранными заново
+        check_indexes(main, main.current_table)
+
+    upload = stub_update(document=stub_document(update))
+    results[f"ingest/{size}/update_s"], _ = timed(asyncio.run, main.update_excel(upload, STUB_CONTEXT))
+    shops = main.current_table
+    print(f"  {size}: ММ в таблице {len(shops)}", flush=True)
+    if main.shop_db is None:
+        check_indexes(main, shops)
+
+    messages = message_corpus(list(shops.iter_records()), args.messages, args.seed)
+
+    async def run_messages():
+        latencies = []
+        for i, text in enumerate(messages):
+            update = stub_update(text, chat_id=i % 50)
+            start = time.perf_counter()
+            await main.listen_chat(update, STUB_CONTEXT)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        total_start = time.perf_counter()
+        latencies = asyncio.run(run_messages())
+        total = time.perf_counter() - total_start
+
+    results[f"match/{size}/msg_per_s"] = len(messages) / total
+    results[f"match/{size}/p50_ms"] = percentile(latencies, 0.5) * 1000
+    results[f"match/{size}/p99_ms"] = percentile(latencies, 0.99) * 1000
+
+
+def bench_labels(main, counts, results):
+    # первая /label после старта: импорт reportlab, шрифт и пробная наклейка
+    results["startup/labels_s"], labels = timed(main.load_labels)
+    rng = random.Random(0)
+    for layout in ("label", "a4"):
+        for n in counts:
+            items = [(f"{rng.randrange(10 ** 12, 10 ** 13)}", rng.choice(DEVICES)) for _ in range(n)]
+            # у части КЕ одинаковые коды — как в реальных списках по одному магазину
+            items += items[: n // 10]
+            items = items[:n]
+            elapsed, pdf = timed(labels.render_labels, items, None, labels.LABEL_LAYOUTS[layout])
+            results[f"labels/{layout}/{n}_s"] = elapsed
+            results[f"labels/{layout}/{n}_kb"] = len(pdf) / 1024
+
+
+# === ОТЧЁТ ===
+
+HIGHER_IS_BETTER = ("msg_per_s",)
+
+
+def print_results(results, previous=None):
+    width = max(len(k) for k in results)
+    header = f"{'метрика':<{width}}  {'значение':>12}"
+    if previous:
+        header += f"  {'было':>12}  {'изменение':>10}"
+    print(header)
+    print("-" * len(header))
+    for key, value in results.items():
+        line = f"{key:<{width}}  {value:>12.4f}"
+        old = (previous or {}).get(key)
+        if old:
+            change = (value - old) / old * 100
+            better = change > 0 if key.endswith(HIGHER_IS_BETTER) else change < 0
+            mark = "" if abs(change) < 5 else ("✅" if better else "⚠")
+            line += f"  {old:>12.4f}  {change:>+9.1f}% {mark}"
+        print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--messages", type=int, default=5000, help="сообщений на размер таблицы")
+    parser.add_argument("--labels", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(REPO, ".bench"))
+    parser.add_argument("--save", help="записать результаты в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+
+    # бот читает config.json и ttf/ из текущей папки — даём ему отдельную
+    work = tempfile.mkdtemp(prefix="mm_bench_")
+    os.symlink(os.path.join(REPO, "ttf"), os.path.join(work, "ttf"))
+    with open(os.path.join(work, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "bot_token": "bench",
+            "admins": [1],
+            "allowed": [1],
+            "storage": args.storage,
+            # без лимита: иначе повторы одного ММ не доходили бы до ответа
+            "rate_limit": {"window_minutes": 0, "store": None},
+        }, f)
+    os.chdir(work)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            import main
+        results = {"startup/import_s": time.perf_counter() - start}
+
+        for size in args.sizes:
+            bench_size(main, data_dir, size, args, results)
+        bench_labels(main, args.labels, results)
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(work, ignore_errors=True)
+
+    print()
+    print_results(results, previous)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "revision": git_revision(),
+                "date": time.strftime("%Y-%m-%d %H:%M"),
+                "python": sys.version.split()[0],
+                "storage": args.storage,
+                "messages": args.messages,
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.save}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,293 @@
+"""Нечёткий поиск ММ: опечатки и латинские буквы-двойники в названиях.
+
+Работает только когда точный индекс ничего не нашёл. Индекс триграмм
+строится при загрузке таблицы; кандидаты отбираются по числу общих триграмм
+и проверяются бит-параллельным расстоянием Дамерау–Левенштейна.
+"""
+from ingest import norm
+from postings import Postings
+
+CACHE_SIZE = 10000
+# сколько раз на одно сообщение можно искать опечатки по индексу (результаты из
+# кеша не считаются): длинное сообщение иначе стоит сотни проверок, а дальше
+# лимита куски сравниваются только точно
+MAX_PIECES = 16
+
+# латиница, которую набирают вместо похожей кириллицы
+LOOKALIKES = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у",
+})
+
+
+def fold(text):
+    """norm, в котором латинские двойники заменены кириллицей"""
+    if not text:
+        return ""
+    return " ".join(norm(str(text).lower().translate(LOOKALIKES)).split())
+
+
+def allowed_distance(length, max_distance):
+    """Сколько опечаток допускается в слове такой длины"""
+    if length < 4:
+        return 0
+    if length < 8:
+        return min(1, max_distance)
+    return min(2, max_distance)
+
+
+def trigrams(term):
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def char_masks(pattern):
+    """Битовые маски позиций каждой буквы образца для distance"""
+    masks = {}
+    for i, ch in enumerate(pattern):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks
+
+
+def distance(pattern, masks, text):
+    """Расстояние Дамерау–Левенштейна (перестановка соседних букв — одна правка).
+
+    Бит-параллельный алгоритм Майерса с поправкой Хюрё на перестановки:
+    столбец матрицы расстояний хранится в двух числах, на букву текста — десяток
+    битовых операций. masks — char_masks(pattern), считаются один раз на образец.
+    """
+    m = len(pattern)
+    if not m:
+        return len(text)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    vp, vn, d0, prev_mask, score = full, 0, 0, 0, m
+    for ch in text:
+        pm = masks.get(ch, 0)
+        tr = (((~d0) & pm) << 1) & prev_mask
+        x = pm | vn
+        d0 = (((x & vp) + vp) ^ vp) | x | tr
+        hp = vn | ~(d0 | vp)
+        hn = vp & d0
+        if hp & last:
+            score += 1
+        elif hn & last:
+            score -= 1
+        x = ((hp << 1) | 1) & full
+        vn = x & d0
+        vp = ((hn << 1) | ~(x | d0)) & full
+        prev_mask = pm
+    return score
+
+
+class FuzzyIndex:
+    """Триграммный индекс по названиям ММ и отдельным словам названий.
+
+    Термин — полное название или слово из него; у термина список позиций ММ.
+    Слова участвуют в поиске только при частичном поиске (как MatchIndex.words).
+    """
+
+    def __init__(self, entries):
+        """entries — (позиция, название) по возрастанию позиций"""
+        self.terms = {}               # номер термина -> свёрнутый (fold) термин
+        self.full = {}                # номер термина -> True — полное название, False — слово
+        self.positions = Postings()   # номер термина -> позиции ММ
+        self.ids = {}                 # (термин, полное?) -> номер термина
+        self.grams = Postings()       # (триграмма, длина термина, полное?) -> номера терминов
+        self.names = {}               # позиция -> свёрнутое название
+        self._length_count = {}
+        self._next_id = 0
+        # результаты по кускам сообщений: слова в чатах повторяются, а индекс неизменен
+        self._cache = {}
+
+        for pos, raw in entries:
+            self._insert(pos, raw)
+        self.lengths = sorted(self._length_count)
+
+    def __getstate__(self):
+        # кэш в снимок таблицы не попадает
+        state = dict(self.__dict__)
+        state["_cache"] = {}
+        return state
+
+    def updated(self, removed, replaced):
+        """Новая версия индекса: removed — освободившиеся позиции, replaced — {позиция: название}.
+
+        Как MatchIndex.updated, текущий индекс не меняется.
+        """
+        new = FuzzyIndex(())
+        new.terms = dict(self.terms)
+        new.full = dict(self.full)
+        new._next_id = self._next_id
+        new.positions = self.positions.version()
+        new.ids = dict(self.ids)
+        new.grams = self.grams.version()
+        new.names = dict(self.names)
+        new._length_count = dict(self._length_count)
+
+        for pos in removed:
+            new._remove(pos)
+        for pos, raw in replaced.items():
+            if fold(raw) != new.names.get(pos):
+                new._remove(pos)
+                new._insert(pos, raw)
+
+        new.lengths = sorted(new._length_count)
+        new.positions.seal()
+        new.grams.seal()
+        return new
+
+    @staticmethod
+    def _name_terms(name):
+        words = name.split()
+        terms = [(name, True)]
+        if len(words) > 1:
+            terms += [(w, False) for w in set(words)]
+        return terms
+
+    def _insert(self, pos, raw):
+        name = fold(raw)
+        if not name:
+            return
+        self.names[pos] = name
+        n = len(name.split())
+        self._length_count[n] = self._length_count.get(n, 0) + 1
+        for term, full in self._name_terms(name):
+            self.positions.add(self._term_id(term, full), pos)
+
+    def _remove(self, pos):
+        name = self.names.pop(pos, None)
+        if name is None:
+            return
+        n = len(name.split())
+        self._length_count[n] -= 1
+        if not self._length_count[n]:
+            del self._length_count[n]
+        for term, full in self._name_terms(name):
+            term_id = self.ids[(term, full)]
+            self.positions.discard(term_id, pos)
+            if term_id not in self.positions:
+                self._drop_term(term_id)
+
+    def _term_id(self, term, full):
+        """Номер термина; новый термин заводится в индексе"""
+        term_id = self.ids.get((term, full))
+        if term_id is None:
+            term_id = self.ids[(term, full)] = self._next_id
+            self._next_id += 1
+            self.terms[term_id] = term
+            self.full[term_id] = full
+            for g in trigrams(term):
+                self.grams.add((g, len(term), full), term_id)
+        return term_id
+
+    def _drop_term(self, term_id):
+        """Убирает термин, у которого не осталось ММ: переименования не копят мёртвые термины"""
+        term = self.terms.pop(term_id)
+        full = self.full.pop(term_id)
+        del self.ids[(term, full)]
+        for g in trigrams(term):
+            self.grams.discard((g, len(term), full), term_id)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _queries(self, tokens, use_partial, covered, max_distance, budget):
+        """Куски сообщения для сравнения с терминами: (начало, слов, текст, полное?).
+
+        Идут по порядку слов, чтобы лимит MAX_PIECES расходовался с начала
+        сообщения. Слова из covered уже нашёл точный поиск — их не трогаем.
+        """
+        for i, token in enumerate(tokens):
+            if i in covered:
+                continue
+            if use_partial:
+                yield i, 1, token, False
+            # кусок из нескольких слов проверяем, только если первое слово похоже на слово названия
+            multi = (token, False) in self.ids or bool(
+                self._limited_near(token, False, max_distance, budget)
+            )
+            for n in self.lengths:
+                if i + n > len(tokens) or (n > 1 and not multi):
+                    break
+                if covered.isdisjoint(range(i, i + n)):
+                    yield i, n, " ".join(tokens[i:i + n]), True
+
+    def _limited_near(self, q, full, max_distance, budget):
+        """_near с допуском по длине куска; budget — [сколько поисков осталось]"""
+        limit = allowed_distance(len(q), max_distance)
+        if not limit:
+            return []
+        if (q, full, limit) not in self._cache:
+            if not budget[0]:
+                return []
+            budget[0] -= 1
+        return self._near(q, full, limit)
+
+    def _near(self, q, full, limit):
+        """Термины на расстоянии до limit от куска q: [(расстояние, номер термина)]"""
+        key = (q, full, limit)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        q_grams = trigrams(q)
+        counts = {}
+        # длина термина отличается от куска не больше чем на число правок
+        for length in range(len(q) - limit, len(q) + limit + 1):
+            for g in q_grams:
+                for term_id in self.grams.get((g, length, full), ()):
+                    counts[term_id] = counts.get(term_id, 0) + 1
+
+        # правка портит не больше трёх триграмм (перестановка соседних букв — четырёх)
+        need = max(1, len(q_grams) - 4 * limit)
+        masks = char_masks(q)
+        result = []
+        for term_id, common in counts.items():
+            if common >= need:
+                d = distance(q, masks, self.terms[term_id])
+                if d <= limit:
+                    result.append((d, term_id))
+
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = result
+        return result
+
+    def matches(self, text, use_partial=False, max_distance=2, covered=frozenset()):
+        """Куски сообщения, похожие на названия ММ: [(начало, слов, позиции ММ)].
+
+        Куски не перекрываются и выбираются от лучших: меньшее расстояние,
+        полное название раньше слова, длинный кусок раньше короткого.
+        Из одинаковых названий берётся первое, как при точном поиске; у слова
+        кандидаты — все ММ, в названии которых оно есть. Несколько позиций —
+        неоднозначный кусок.
+        """
+        tokens = fold(text).split()
+        found = []
+        budget = [MAX_PIECES]
+        for start, n, q, full in self._queries(tokens, use_partial, covered, max_distance, budget):
+            # сначала точное совпадение после замены латиницы — без перебора
+            term_id = self.ids.get((q, full))
+            if term_id is not None:
+                near = [(0, term_id)]
+            else:
+                near = self._limited_near(q, full, max_distance, budget)
+            if near:
+                best = min(d for d, _ in near)
+                found.append((best, not full, -n, start, [t for d, t in near if d == best]))
+
+        found.sort()
+        taken = set()
+        result = []
+        for _, is_word, neg_n, start, terms in found:
+            span = range(start, start - neg_n)
+            if not taken.isdisjoint(span):
+                continue
+            taken.update(span)
+            positions = set()
+            for term_id in terms:
+                rows = self.positions[term_id]
+                positions.update(rows if is_word else rows[:1])
+            result.append((start, -neg_n, sorted(positions)))
+        return sorted(result)
@@ -0,0 +1,295 @@
+"""Загрузка выгрузки ММ: чтение Excel, фильтр по филиалам, нормализация и снимок таблицы.
+
+Один и тот же путь используют старт бота (load_table) и загрузка файла в чат (update_excel).
+"""
+import hashlib
+import os
+import pickle
+import re
+from dataclasses import dataclass
+
+import openpyxl
+import pandas as pd
+
+SNAPSHOT_VERSION = 4   # менять при изменении ShopTable и индексов поиска: снимок хранит их целиком
+
+DEFAULT_BRANCHES = ["Уфа Восток", "Уфа Запад"]
+
+def norm(text):
+    if not text:
+        return ""
+    text = str(text).strip().lower().replace("ё", "е")
+    text = re.sub(r'[^а-яa-z0-9\s]', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text
+
+
+def scan_names(tokens, lengths, find_name, find_word=None):
+    """Все ММ из слов сообщения за один проход: [(начало, слов, позиция, полное?)].
+
+    find_name(кортеж слов) -> позиция ММ с таким названием или None; в каждом
+    месте берётся самое длинное название из lengths. Слово вне найденных
+    названий ищется через find_word (частичный поиск), если он задан.
+    """
+    result = []
+    i = 0
+    n = len(tokens)
+    while i < n:
+        for length in reversed(lengths):
+            if i + length <= n:
+                pos = find_name(tuple(tokens[i:i + length]))
+                if pos is not None:
+                    result.append((i, length, pos, True))
+                    i += length
+                    break
+        else:
+            if find_word is not None:
+                pos = find_word(tokens[i])
+                if pos is not None:
+                    result.append((i, 1, pos, False))
+            i += 1
+    return result
+
+
+# падежные окончания, которые отрезаются от фамилии: «у Иванова», «Петровой»
+NAME_ENDINGS = (
+    "ыми", "ими", "ого", "его", "ому", "ему",
+    "ой", "ей", "ым", "им", "ом", "ем", "ых", "их", "ую", "ая", "ий", "ый",
+    "а", "я", "у", "ю", "е", "ы",
+)
+
+
+def name_stem(word):
+    for ending in NAME_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 4:
+            return word[:-len(ending)]
+    return word
+
+
+def tech_keys(text):
+    """Основы слов ФИО для поиска системотехника по фамилии; инициалы не считаются"""
+    return {name_stem(w) for w in norm(text).split() if len(w) >= 4}
+
+
+def phone_keys(text):
+    """Телефоны в тексте — последние 10 цифр, без +7/8 и разделителей"""
+    keys = set()
+    for m in re.findall(r"\+?\d[\d\s()\-]{8,}\d", str(text)):
+        digits = re.sub(r"\D", "", m)
+        if len(digits) >= 10:
+            keys.add(digits[-10:])
+    return keys
+
+
+REQUIRED_COLUMNS = [
+    "магазин",
+    "код",
+    "статус",
+    "тип",
+    "фио системотехника",
+    "телефон системотехника",
+    "филиал"
+]
+
+# колонки, которые нужны только для полного отчёта
+REPORT_COLUMNS = [
+    "формат",
+    "дата открытия",
+    "дата закрытия",
+    "email",
+    "полный адрес"
+]
+
+
+@dataclass(slots=True)
+class ShopRecord:
+    shop: str
+    mm_type: str
+    code: str
+    status: str
+    branch: str
+    tech: str
+    tech_phone: str
+    format_mm: str
+    open_date: str
+    close_date: str
+    email: str
+    address: str
+
+
+def cell(v):
+    if pd.isna(v):
+        return "-"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+
+def format_phone(v):
+    if pd.isna(v):
+        return "-"
+    try:
+        return str(int(v))
+    except (TypeError, ValueError):
+        return str(v).strip()
+
+
+# поля ShopRecord по порядку: колонка таблицы и функция нормализации значения
+RECORD_COLUMNS = [
+    ("магазин", cell),
+    ("тип", cell),
+    ("код", cell),
+    ("статус", cell),
+    ("филиал", cell),
+    ("фио системотехника", cell),
+    ("телефон системотехника", format_phone),
+    ("формат", cell),
+    ("дата открытия", cell),
+    ("дата закрытия", cell),
+    ("email", cell),
+    ("полный адрес", cell),
+]
+
+
+def select_columns(table):
+    """Оставляет только колонки, которые использует бот"""
+    cols = [c for c in REQUIRED_COLUMNS + REPORT_COLUMNS if c in table.columns]
+    return table[cols].reset_index(drop=True)
+
+
+def build_records(table):
+    """Собирает компактные записи ММ по колонкам, без построчного доступа к pandas.
+
+    Возвращает записи и хеши их содержимого для поиска изменений.
+    """
+    n = len(table)
+    columns = {}
+    for name, fmt in RECORD_COLUMNS:
+        if name in table.columns:
+            columns[name] = [fmt(v) for v in table[name].tolist()]
+        else:
+            columns[name] = ["-"] * n
+
+    records = [ShopRecord(*values) for values in zip(*columns.values())]
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).tolist()
+    return records, hashes
+
+
+def record_keys(records):
+    """Ключ ММ — код; повторы кода в выгрузке различаются порядковым номером"""
+    seen = {}
+    keys = []
+    for r in records:
+        n = seen.get(r.code, 0)
+        seen[r.code] = n + 1
+        keys.append((r.code, n))
+    return keys
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def normalize_branches(branches):
+    return sorted({str(b).strip().lower() for b in branches})
+
+
+def save_snapshot(path, table, source_hash, branches, updated_at):
+    """Сохраняет готовую таблицу ММ со всеми индексами: старт по снимку обходится без сборки"""
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "source_hash": source_hash,
+        "branches": normalize_branches(branches),
+        "updated_at": updated_at,
+        "table": table,
+    }
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("⚠ Не удалось сохранить снимок таблицы:", e)
+
+
+def load_snapshot(path, source_hash, branches):
+    """Возвращает (таблица, дата выгрузки), если снимок построен из этого же файла
+    с теми же филиалами"""
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("⚠ Снимок таблицы повреждён:", e)
+        return None
+
+    if (
+        not isinstance(snapshot, dict)
+        or snapshot.get("version") != SNAPSHOT_VERSION
+        or snapshot.get("source_hash") != source_hash
+        or snapshot.get("branches") != normalize_branches(branches)
+    ):
+        return None
+    return snapshot["table"], snapshot["updated_at"]
+
+
+def read_table(path, branches):
+    """Потоково читает первый лист Excel (openpyxl read_only).
+
+    Берутся только колонки, нужные боту, и только строки филиалов из branches
+    (сравнение без учёта регистра), поэтому память не зависит от размера выгрузки.
+    """
+    branches = set(normalize_branches(branches))
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+
+        wanted = {}
+        for i, name in enumerate(header):
+            name = str(name).strip().lower() if name is not None else ""
+            if name in REQUIRED_COLUMNS + REPORT_COLUMNS and name not in wanted:
+                wanted[name] = i
+
+        columns = list(wanted)
+        branch_i = wanted.get("филиал")
+        if branch_i is None:
+            return pd.DataFrame(columns=columns)
+
+        width = max(wanted.values()) + 1
+        data = []
+        for row in rows:
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            branch = row[branch_i]
+            if branch is None or str(branch).strip().lower() not in branches:
+                continue
+            data.append([row[i] for i in wanted.values()])
+    finally:
+        wb.close()
+
+    return pd.DataFrame(data, columns=columns)
+
+
+def load_excel(path, branches):
+    """Читает выгрузку, проверяет колонки и оставляет строки филиалов branches.
+
+    Возвращает (таблица, None) или (None, текст ошибки).
+    """
+    table = read_table(path, branches)
+
+    missing = [col for col in REQUIRED_COLUMNS if col not in table.columns]
+    if missing:
+        return None, f"Нет обязательных столбцов: {', '.join(missing)}"
+
+    if table.empty:
+        return None, f"В файле нет строк с филиалами {', '.join(branches)}."
+
+    return select_columns(table), None
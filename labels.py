@@ -0,0 +1,270 @@
+"""Наклейки со штрихкодами Code128: шаблоны, раскладка по листу и сборка PDF.
+
+Модуль тянет reportlab и регистрирует шрифт, поэтому main.py импортирует его
+лениво — при первом /label или фоновым прогревом после старта (load_labels).
+"""
+import functools
+import hashlib
+import io
+import threading
+from dataclasses import dataclass
+
+from reportlab.graphics.barcode import code128
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+pdfmetrics.registerFont(TTFont("DejaVu", "ttf/DejaVuSans.ttf"))
+
+BULK_LABELS_PER_FILE = 2000
+
+# размеры в мм, как у прежнего ImageWriter python-barcode
+BARCODE_OPTIONS = {
+    "module_width": 0.25,
+    "module_height": 5,
+    "quiet_zone": 1,
+}
+BARCODE_CACHE_SIZE = 1024
+
+# виджет штрихкода хранит холст во время отрисовки — рисуем по одному
+barcode_draw_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
+def barcode_widget(code: str, module_width, module_height, quiet_zone):
+    """Кодирует Code128 один раз для кода и параметров; результат общий для всех PDF"""
+    bc = code128.Code128(
+        code,
+        barWidth=module_width * mm,
+        barHeight=module_height * mm,
+        quiet=False,
+        humanReadable=False,
+    )
+    form_name = "bc" + hashlib.sha1(repr((code, module_width, module_height)).encode()).hexdigest()[:16]
+    return bc, bc.width + 2 * quiet_zone * mm, form_name
+
+
+def draw_barcode(c, code: str, x, y, width, height):
+    """Рисует Code128 векторными штрихами прямо на холсте.
+
+    Штрихкод с полями quiet_zone вписывается в прямоугольник с сохранением
+    пропорций и центрируется, как раньше картинка с preserveAspectRatio.
+    Штрихи попадают в PDF один раз (Form XObject), повторы кода ссылаются на него.
+    """
+    opts = BARCODE_OPTIONS
+    bc, full_width, form_name = barcode_widget(
+        code, opts["module_width"], opts["module_height"], opts["quiet_zone"]
+    )
+
+    if not c.hasForm(form_name):
+        c.beginForm(form_name, 0, 0, bc.width, bc.height)
+        with barcode_draw_lock:
+            bc.drawOn(c, 0, 0)
+        c.endForm()
+
+    scale = min(width / full_width, height / bc.height)
+
+    c.saveState()
+    c.translate(
+        x + (width - bc.width * scale) / 2,
+        y + (height - bc.height * scale) / 2,
+    )
+    c.scale(scale, scale)
+    c.doForm(form_name)
+    c.restoreState()
+
+
+LABEL_FONT = "DejaVu"
+
+
+@dataclass(frozen=True, slots=True)
+class LabelLayout:
+    """Шаблон наклейки; размеры в пунктах, координаты от левого нижнего угла наклейки"""
+    label_width: float
+    label_height: float
+    barcode_box: tuple             # (x, y, ширина, высота)
+    code_y: float                  # базовая линия кода под штрихкодом
+    code_font_size: float
+    text_top: float                # базовая линия первой строки названия
+    text_width: float
+    text_font_size: float
+    text_leading: float
+    text_max_lines: int
+    title_font_size: float
+    page_size: tuple | None = None     # лист с сеткой наклеек; None — лист размером с наклейку
+    columns: int = 1
+    rows: int = 1
+
+
+LABEL_60X30 = dict(
+    label_width=60 * mm,
+    label_height=30 * mm,
+    barcode_box=(5 * mm, 8 * mm, 50 * mm, 12 * mm),
+    code_y=6 * mm,
+    code_font_size=7,
+    text_top=26 * mm,
+    text_width=56 * mm,
+    text_font_size=6,
+    text_leading=7.5,
+    text_max_lines=3,
+    title_font_size=10,
+)
+
+LABEL_LAYOUTS = {
+    # термопринтер: одна наклейка 60×30 мм на страницу
+    "label": LabelLayout(**LABEL_60X30),
+    # обычный принтер: 3×9 наклеек 60×30 мм на листе A4
+    "a4": LabelLayout(**LABEL_60X30, page_size=A4, columns=3, rows=9),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def label_origins(layout):
+    """Левые нижние углы наклеек на странице, сверху вниз и слева направо"""
+    if layout.page_size is None:
+        return ((0, 0),)
+    page_w, page_h = layout.page_size
+    margin_x = (page_w - layout.columns * layout.label_width) / 2
+    margin_y = (page_h - layout.rows * layout.label_height) / 2
+    return tuple(
+        (margin_x + col * layout.label_width, page_h - margin_y - (row + 1) * layout.label_height)
+        for row in range(layout.rows)
+        for col in range(layout.columns)
+    )
+
+
+@functools.lru_cache(maxsize=8192)
+def text_width(text: str, font_size):
+    return pdfmetrics.stringWidth(text, LABEL_FONT, font_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def wrap_text(text: str, width, font_size, max_lines):
+    """Разбивает текст на строки по реальной ширине шрифта.
+
+    Возвращает кортеж (строка, ширина); лишние строки обрезаются с «…».
+    """
+    lines = []
+    current = ""
+    for word in text.split():
+        candidate = f"{current} {word}" if current else word
+        if text_width(candidate, font_size) <= width:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+        # слово длиннее строки режем по символам
+        current = ""
+        for ch in word:
+            if current and text_width(current + ch, font_size) > width:
+                lines.append(current)
+                current = ""
+            current += ch
+    if current:
+        lines.append(current)
+
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        last = lines[-1]
+        while last and text_width(last + "…", font_size) > width:
+            last = last[:-1]
+        lines[-1] = last.rstrip() + "…"
+
+    return tuple((line, text_width(line, font_size)) for line in lines)
+
+
+class LabelSheet:
+    """PDF с наклейками по шаблону LabelLayout: по одной на страницу или сеткой на листе"""
+
+    def __init__(self, out, layout):
+        self.layout = layout
+        self.canvas = canvas.Canvas(
+            out, pagesize=layout.page_size or (layout.label_width, layout.label_height)
+        )
+        self.origins = label_origins(layout)
+        self.slot = 0
+        self.pages = 1
+
+    def _next_origin(self):
+        if self.slot == len(self.origins):
+            self.canvas.showPage()
+            self.slot = 0
+            self.pages += 1
+        x, y = self.origins[self.slot]
+        self.slot += 1
+        if self.layout.page_size is not None:
+            # контур для резки
+            self.canvas.setStrokeGray(0.85)
+            self.canvas.setLineWidth(0.3)
+            self.canvas.rect(x, y, self.layout.label_width, self.layout.label_height)
+        return x, y
+
+    def add_title(self, text: str):
+        """Наклейка с названием магазина"""
+        layout = self.layout
+        x, y = self._next_origin()
+        self.canvas.setFont(LABEL_FONT, layout.title_font_size)
+        self.canvas.drawCentredString(x + layout.label_width / 2, y + layout.label_height / 2, text)
+
+    def add_item(self, code: str, name: str):
+        """Наклейка КЕ: название сверху, штрихкод и код под ним"""
+        c = self.canvas
+        layout = self.layout
+        x, y = self._next_origin()
+
+        bx, by, bw, bh = layout.barcode_box
+        draw_barcode(c, code, x + bx, y + by, bw, bh)
+
+        c.setFont(LABEL_FONT, layout.code_font_size)
+        c.drawCentredString(x + layout.label_width / 2, y + layout.code_y, code)
+
+        c.setFont(LABEL_FONT, layout.text_font_size)
+        lines = wrap_text(name, layout.text_width, layout.text_font_size, layout.text_max_lines)
+        for i, (line, width) in enumerate(lines):
+            c.drawString(x + (layout.label_width - width) / 2, y + layout.text_top - i * layout.text_leading, line)
+
+    def close(self):
+        self.canvas.save()
+
+
+def render_labels(items, shop_name=None, layout=LABEL_LAYOUTS["label"]):
+    """Собирает PDF наклеек в памяти; в боте выполняется в пуле label_executor"""
+    buf = io.BytesIO()
+    sheet = LabelSheet(buf, layout)
+
+    # 🔹 Если есть один магазин, делаем наклейку с названием магазина
+    if shop_name:
+        sheet.add_title(shop_name)
+
+    for code, name in items:
+        sheet.add_item(code, name)
+
+    sheet.close()
+    return buf.getvalue()
+
+
+def render_label_documents(items, layout, limit):
+    """Генератор PDF по частям: не больше BULK_LABELS_PER_FILE наклеек и limit байт в файле.
+
+    Каждая часть собирается, отдаётся и освобождается до начала следующей.
+    """
+    for start in range(0, len(items), BULK_LABELS_PER_FILE):
+        yield from _render_within_limit(items[start:start + BULK_LABELS_PER_FILE], layout, limit)
+
+
+def _render_within_limit(items, layout, limit):
+    pdf = render_labels(items, None, layout)
+    if len(pdf) <= limit or len(items) == 1:
+        yield pdf
+        return
+    del pdf
+    mid = len(items) // 2
+    yield from _render_within_limit(items[:mid], layout, limit)
+    yield from _render_within_limit(items[mid:], layout, limit)
+
+
+def warm_up():
+    """Первый PDF заметно дольше: reportlab догружает модули и разбирает шрифт"""
+    render_labels([("0000000000000", "Прогрев")], "Прогрев", LABEL_LAYOUTS["a4"])
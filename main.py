@@ -1,34 +1,112 @@
-import pandas as pd
-from datetime import datetime, timedelta
-from telegram import Update
+import time
+_phase_started = time.perf_counter()
+
+from datetime import datetime
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    ApplicationBuilder, MessageHandler, CommandHandler,
+    ApplicationBuilder, MessageHandler, CommandHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
-import time
 import os
 import re
 import json
+import asyncio
+import shutil
+from dataclasses import dataclass
+
+from fuzzy import FuzzyIndex
+from postings import Postings
+from ratelimit import RateLimiter
+from shopdb import ShopDatabase
+from stats import Metrics, serve_prometheus
+from updates import ChatOrderedProcessor
+from versions import DatasetVersion, VersionStore
+from ingest import (
+    DEFAULT_BRANCHES, build_records, file_hash, load_excel, load_snapshot,
+    name_stem, norm, normalize_branches, phone_keys, record_keys, save_snapshot,
+    scan_names, tech_keys,
+)
+
+# === BARCODE / PDF === (сам модуль наклеек labels.py грузится лениво, см. load_labels)
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+STARTUP = {}             # этап запуска -> секунды
+
+
+def startup_phase(name):
+    """Закрывает этап запуска: время с конца предыдущего этапа"""
+    global _phase_started
+    now = time.perf_counter()
+    STARTUP[name] = now - _phase_started
+    _phase_started = now
+
+
+def describe_startup():
+    return f"🚀 Запуск за {sum(STARTUP.values()):.2f} с: " + ", ".join(
+        f"{name} {seconds:.2f}" for name, seconds in STARTUP.items()
+    )
+
+
+startup_phase("импорт")
 
-# === BARCODE / PDF ===
-import barcode
-from barcode.writer import ImageWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
-import tempfile
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-
-pdfmetrics.registerFont(TTFont("DejaVu", "ttf/DejaVuSans.ttf"))
 CONFIG_FILE = "config.json"
+DATA_FILE = "data.xlsx"
+UPLOAD_FILE = "data.upload.xlsx"   # загруженный файл до проверки; data.xlsx заменяется только проверенным
+# состояние бота, которое должно пережить передеплой: в docker-compose это том
+STATE_DIR = "state"
+SNAPSHOT_FILE = os.path.join(STATE_DIR, "data.snapshot.pkl")
+DB_FILE = os.path.join(STATE_DIR, "shops.db")
+VERSIONS_DIR = os.path.join(STATE_DIR, "versions")
+
+DEFAULT_RATE_LIMIT = {
+    "window_minutes": 60,          # не отвечать по одному ММ в чате чаще
+    "full_report_exempt": True,    # полный отчёт отдаётся без ограничения
+    "store": os.path.join(STATE_DIR, "ratelimit.db"),   # null — хранить только в памяти
+}
+
+DEFAULT_REPLIES = {
+    "max_matches": 5,              # сколько ММ из одного сообщения попадает в ответ
+}
+
+DEFAULT_METRICS = {
+    "port": None,                  # порт для Prometheus (/metrics); null — не поднимать
+    "host": "127.0.0.1",
+}
+
+DEFAULT_FUZZY = {
+    "enabled": True,
+    "max_distance": 2,             # опечаток в длинном слове (в коротком — меньше)
+    "max_choices": 5,              # сколько вариантов предлагать при неоднозначности
+}
+
+DEFAULT_VERSIONS = {
+    "keep": 5,                     # сколько последних версий хранить для /rollback (файлы в state/versions)
+}
+
+DEFAULT_TELEGRAM = {
+    "concurrent_updates": 32,      # обновлений одновременно, включая ждущие своей очереди в чате
+    "connection_pool_size": 32,    # соединений HTTP-клиента для запросов бота
+    "pool_timeout": 5,             # сколько ждать свободное соединение, секунды
+    "base_url": None,              # свой Bot API (локальный сервер, тестовая заглушка)
+    "base_file_url": None,
+}
+
+DEFAULT_WEBHOOK = {
+    "url": None,                   # внешний адрес бота, например https://bot.example.com; null — long polling
+    "listen": "0.0.0.0",
+    "port": 8443,
+    "path": "telegram",
+    "secret_token": None,          # Telegram присылает его в заголовке каждого запроса
+}
 
 def load_config():
     if not os.path.exists(CONFIG_FILE):
         config = {
             "bot_token": os.getenv("BOT_TOKEN", ""),
             "admins": [],
-            "allowed": []
+            "allowed": [],
+            "branches": DEFAULT_BRANCHES
         }
         save_config(config)
         return config
@@ -54,138 +132,434 @@ def save_config(data):
 
 
 config = load_config()
+os.makedirs(STATE_DIR, exist_ok=True)
 TOKEN = config["bot_token"]
 ADMINS = set(config["admins"])
 ALLOWED = set(config["allowed"])
-
-df = pd.DataFrame()
-last_response_time = {}
-
-
-def is_allowed(user_id):
-    return user_id in ALLOWED
+# филиалы, ММ которых берутся из выгрузки; для другого региона — свой список в config.json
+BRANCHES = config.get("branches", DEFAULT_BRANCHES)
+
+RATE_LIMIT = {**DEFAULT_RATE_LIMIT, **config.get("rate_limit", {})}
+FUZZY = {**DEFAULT_FUZZY, **config.get("fuzzy", {})}
+REPLIES = {**DEFAULT_REPLIES, **config.get("replies", {})}
+METRICS = {**DEFAULT_METRICS, **config.get("metrics", {})}
+TELEGRAM = {**DEFAULT_TELEGRAM, **config.get("telegram", {})}
+WEBHOOK = {**DEFAULT_WEBHOOK, **config.get("webhook", {})}
+VERSIONS = {**DEFAULT_VERSIONS, **config.get("versions", {})}
+# "memory" — таблица в памяти (снимок в data.snapshot.pkl), "sqlite" — база shops.db
+STORAGE = config.get("storage", "memory")
+shop_db = ShopDatabase(DB_FILE) if STORAGE == "sqlite" else None
+
+current_table = None     # ShopTable, подменяется целиком одной ссылкой
+# shops.db меняется на месте, поэтому с sqlite хранится только текущая версия, без файла
+versions = VersionStore(VERSIONS["keep"], VERSIONS_DIR) if shop_db is None else VersionStore(1)
+ingest_lock = asyncio.Lock()
+rate_limiter = RateLimiter(RATE_LIMIT["window_minutes"] * 60, RATE_LIMIT["store"])
+
+# /label рисуется в отдельных потоках; больше LABEL_WORKERS запросов ждут очереди
+LABEL_WORKERS = 2
+label_executor = ThreadPoolExecutor(max_workers=LABEL_WORKERS, thread_name_prefix="labels")
+label_slots = asyncio.Semaphore(LABEL_WORKERS)
+labels = None            # модуль labels.py: reportlab и шрифт нужны только для /label
+
+
+startup_phase("конфиг")
+
+metrics = Metrics(
+    "mm_bot",
+    counters={
+        "messages": "Сообщений в чатах",
+        "matches": "Ответов по ММ",
+        "rate_limited": "Подавлено лимитом",
+        "denied": "Отказов в доступе",
+    },
+    histograms={
+        "match": "Поиск ММ по сообщению",
+        "reply": "Отправка ответа",
+        "label_render": "Генерация PDF наклеек",
+        "ingest": "Обработка выгрузки",
+    },
+)
 
 
-def norm(text):
-    if not text:
-        return ""
-    text = str(text).strip().lower()
-    text = re.sub(r'[^а-яa-z0-9\s]', '', text)
-    text = re.sub(r'\s+', ' ', text)
-    return text
+def load_labels():
+    """Импортирует labels.py и рисует пробный PDF; выполняется в пуле label_executor"""
+    global labels
+    if labels is None:
+        started = time.perf_counter()
+        import labels as module
+        module.warm_up()
+        labels = module
+        print(f"🏷 Модуль наклеек загружен за {time.perf_counter() - started:.2f} с")
+    return labels
 
 
-REQUIRED_COLUMNS = [
-    "магазин",
-    "код",
-    "статус",
-    "тип",
-    "фио системотехника",
-    "телефон системотехника",
-    "филиал"
-]
-
-def generate_barcode(code: str, filename: str):
-    Code128 = barcode.get_barcode_class("code128")
-    obj = Code128(code, writer=ImageWriter())
-    obj.save(
-        filename,
-        {
-            "module_width": 0.25,
-            "module_height": 5,
-            "font_size": 0,
-            "quiet_zone": 1,
-            "write_text": False
-        }
-    )
+async def get_labels():
+    if labels is not None:
+        return labels
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(label_executor, load_labels)
 
 
-def generate_labels_pdf(items: list[tuple[str, str]], pdf_path: str):
-    c = canvas.Canvas(pdf_path, pagesize=(60*mm, 30*mm))
-    c.setFont("DejaVu", 7)
+def is_allowed(user_id):
+    if user_id in ALLOWED:
+        return True
+    metrics.inc("denied")
+    return False
+
+
+class MatchIndex:
+    """Индекс названий ММ для поиска по сообщению за один проход"""
+
+    def __init__(self, names):
+        self.names = []             # нормализованное название по позиции строки
+        self.full = Postings()      # кортеж слов названия -> строки с таким названием
+        self.words = Postings()     # слово -> строки, где оно есть
+        self.lengths = []           # встречающиеся длины названий (в словах)
+        self._length_count = {}
+
+        for pos, raw in enumerate(names):
+            self.names.append("")
+            self._insert(pos, raw)
+        self.lengths = sorted(self._length_count)
+
+    def _insert(self, pos, raw):
+        name = norm(str(raw))
+        self.names[pos] = name
+        tokens = tuple(name.split())
+        if not tokens:
+            return
+        self.full.add(tokens, pos)
+        self._length_count[len(tokens)] = self._length_count.get(len(tokens), 0) + 1
+        for w in set(tokens):
+            self.words.add(w, pos)
+
+    def _remove(self, pos):
+        tokens = tuple(self.names[pos].split())
+        self.names[pos] = ""
+        if not tokens:
+            return
+        self.full.discard(tokens, pos)
+        for w in set(tokens):
+            self.words.discard(w, pos)
+        self._length_count[len(tokens)] -= 1
+        if not self._length_count[len(tokens)]:
+            del self._length_count[len(tokens)]
+
+    def updated(self, removed, replaced):
+        """Новая версия индекса: removed — освободившиеся позиции, replaced — {позиция: название}.
+
+        Текущий индекс не меняется, поэтому им можно продолжать отвечать.
+        """
+        new = MatchIndex([])
+        new.names = list(self.names)
+        new.full = self.full.version()
+        new.words = self.words.version()
+        new._length_count = dict(self._length_count)
+
+        for pos in removed:
+            new._remove(pos)
+        for pos, raw in replaced.items():
+            if pos < len(new.names):
+                new._remove(pos)
+            else:
+                new.names.append("")
+            new._insert(pos, raw)
+
+        new.lengths = sorted(new._length_count)
+        new.full.seal()
+        new.words.seal()
+        return new
+
+    def find_all(self, msg_norm, use_partial=False):
+        """Все ММ из сообщения: [(начало, слов, позиция, полное?)], см. scan_names"""
+        def first(table, key):
+            rows = table.get(key)
+            return rows[0] if rows else None
+
+        return scan_names(
+            msg_norm.split(),
+            self.lengths,
+            lambda words: first(self.full, words),
+            (lambda word: first(self.words, word)) if use_partial else None,
+        )
 
-    tmp_dir = tempfile.gettempdir()
 
-    for code, name in items:
-        barcode_base = os.path.join(tmp_dir, code)
-        barcode_png = barcode_base + ".png"
+def render_short(rec):
+    branch_suffix = f" ! {rec.branch}" if rec.branch.lower() == "уфа запад" else ""
+    status_text = f"<b>{rec.status}</b>" if rec.status.lower() == "закрыт" else rec.status
+
+    line1 = f"{rec.shop} {rec.mm_type} ({rec.code}) {status_text}{branch_suffix}"
+    line2 = f"{rec.tech} {rec.tech_phone}"
+    return f"{line1}\n{line2}"
+
+
+def render_full(rec):
+    # дата выгрузки добавляется при ответе: она меняется с каждой загрузкой
+    reply_lines = [
+        f"Магазин: {rec.mm_type} {rec.shop} ({rec.code})",
+        f"Формат: {rec.format_mm}",
+        f"Статус: {rec.status}",
+        f"Филиал: {rec.branch}",
+        f"Дата открытия: {rec.open_date}",
+        f"Дата закрытия: {rec.close_date}",
+        f"Email: {rec.email}",
+        f"ФИО системотехника: {rec.tech} ({rec.tech_phone})",
+        f"Полный адрес: {rec.address}",
+    ]
+    return "\n".join(reply_lines)
+
+
+@dataclass(slots=True)
+class FieldIndex:
+    """Вторичные индексы по полям ММ: значение -> позиции (по возрастанию)"""
+    codes: dict            # код ММ
+    techs: dict            # основа слова ФИО системотехника (см. tech_keys)
+    phones: dict           # телефон системотехника, последние 10 цифр
+
+
+def record_fields(rec):
+    """(поле FieldIndex, значение) записи ММ"""
+    return (
+        [("codes", rec.code)]
+        + [("techs", key) for key in tech_keys(rec.tech)]
+        + [("phones", key) for key in phone_keys(rec.tech_phone)]
+    )
 
-        generate_barcode(code, barcode_base)
 
-        img = ImageReader(barcode_png)
+def build_field_index(records):
+    index = FieldIndex(Postings(), Postings(), Postings())
+    for pos, rec in enumerate(records):
+        if rec is None:
+            continue
+        for field, key in record_fields(rec):
+            getattr(index, field).setdefault(key, []).append(pos)
+    return index
+
+
+def update_field_index(index, old_records, new_records, positions):
+    """Новая версия FieldIndex: перезаписываются только ключи ММ на позициях positions"""
+    new = FieldIndex(index.codes.version(), index.techs.version(), index.phones.version())
+    for pos in positions:
+        old = old_records[pos] if pos < len(old_records) else None
+        if old is not None:
+            for field, key in record_fields(old):
+                getattr(new, field).discard(key, pos)
+        rec = new_records[pos]
+        if rec is not None:
+            for field, key in record_fields(rec):
+                getattr(new, field).add(key, pos)
+    for table in (new.codes, new.techs, new.phones):
+        table.seal()
+    return new
+
+
+@dataclass(slots=True)
+class ShopTable:
+    records: list          # ShopRecord по позиции; None — ММ удалён последней выгрузкой
+    replies: list          # готовые ответы (краткий, полный) по позиции записи
+    hashes: list           # хеш содержимого записи по позиции
+    keys: dict             # ключ ММ (см. record_keys) -> позиция
+    index: MatchIndex
+    fuzzy: FuzzyIndex      # нечёткий поиск, если точный ничего не нашёл
+    fields: FieldIndex
+    updated_at: str | None
+
+    def _hit(self, pos):
+        return self.records[pos], self.index.names[pos], *self.replies[pos]
+
+    def lookup_all(self, msg_norm, use_partial=False):
+        """ММ из сообщения: [(начало, слов, полное?, hit)],
+        hit — (ShopRecord, название, краткий ответ, полный ответ)"""
+        return [
+            (start, n, full, self._hit(pos))
+            for start, n, pos, full in self.index.find_all(msg_norm, use_partial)
+        ]
+
+    def find_code(self, code):
+        """hit первого ММ с этим кодом или None"""
+        rows = self.fields.codes.get(code)
+        return self._hit(rows[0]) if rows else None
+
+    def find_tech(self, stems):
+        """ММ системотехников, в ФИО которых есть слово с одной из основ"""
+        return self._records_by(self.fields.techs, stems)
+
+    def find_phone(self, phones):
+        """ММ системотехников с одним из телефонов"""
+        return self._records_by(self.fields.phones, phones)
+
+    def _records_by(self, index, keys):
+        positions = set()
+        for key in keys:
+            positions.update(index.get(key, ()))
+        return [self.records[pos] for pos in sorted(positions)]
+
+    def suggest(self, text, use_partial=False, max_distance=2, covered=frozenset()):
+        """Нечёткий поиск: [(начало, слов, [hit кандидатов])], см. FuzzyIndex.matches"""
+        return [
+            (start, n, [self._hit(pos) for pos in positions])
+            for start, n, positions in self.fuzzy.matches(text, use_partial, max_distance, covered)
+        ]
+
+    def iter_records(self):
+        return (rec for rec in self.records if rec is not None)
+
+    def fingerprint(self):
+        """Ключ ММ -> (позиция, хеш строки, название) для сравнения с новой выгрузкой"""
+        return {
+            key: (pos, self.hashes[pos], self.records[pos].shop)
+            for key, pos in self.keys.items()
+        }
 
-        # штрихкод
-        c.drawImage(
-            img,
-            5*mm,
-            10*mm,
-            width=50*mm,
-            height=5*mm,
-            preserveAspectRatio=True,
-            mask="auto"
-        )
+    def __len__(self):
+        return len(self.keys)
 
-        # код под штрихкодом
-        c.setFont("DejaVu", 7)
-        c.drawCentredString(30 * mm, 6 * mm, code)
 
-        # название КЕ, центрируем
-        text_obj = c.beginText()
-        text_obj.setFont("DejaVu", 6)
-        text_lines = split_text(name, 28)
-        y_start = 26 * mm  # верхний отступ
-        for i, line in enumerate(text_lines):
-            text_obj.setTextOrigin(30 * mm, y_start - i * 5)  # вертикальный шаг
-            text_obj.textLine(line.center(28))
-        c.drawText(text_obj)
+@dataclass(slots=True)
+class TableDiff:
+    added: list            # позиции в новой выгрузке
+    removed: list          # позиции в текущей таблице
+    modified: list         # (позиция в текущей таблице, позиция в новой выгрузке)
 
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
 
-        c.showPage()
 
-        if os.path.exists(barcode_png):
-            os.remove(barcode_png)
+def build_table(records, hashes, updated_at=None):
+    """Строит готовые ответы и индексы поиска по записям ММ (результат build_records)"""
+    return ShopTable(
+        records=records,
+        replies=[(render_short(r), render_full(r)) for r in records],
+        hashes=hashes,
+        keys={k: pos for pos, k in enumerate(record_keys(records))},
+        index=MatchIndex([r.shop for r in records]),
+        fuzzy=FuzzyIndex(enumerate(r.shop for r in records)),
+        fields=build_field_index(records),
+        updated_at=updated_at,
+    )
 
-    c.save()
 
+def diff_table(old, new_keys, new_hashes):
+    """Сравнивает текущие данные (fingerprint) с новой выгрузкой за один проход по хешам строк"""
+    added = []
+    modified = []
+    for i, key in enumerate(new_keys):
+        entry = old.get(key)
+        if entry is None:
+            added.append(i)
+        elif entry[1] != new_hashes[i]:
+            modified.append((entry[0], i))
+
+    new_set = set(new_keys)
+    removed = [entry[0] for key, entry in old.items() if key not in new_set]
+    return TableDiff(added, removed, modified)
+
+
+def write_shop_db(records, hashes, keys, diff, updated_at, source_hash):
+    """Пишет выгрузку в shop_db: целиком (diff=None) или только изменения"""
+    def row(pos, i):
+        rec = records[i]
+        return pos, keys[i], hashes[i], rec, render_short(rec), render_full(rec)
+
+    if diff is None:
+        rows = [row(i, i) for i in range(len(records))]
+        removed = []
+    else:
+        rows = [row(pos, i) for pos, i in diff.modified] + [row(None, i) for i in diff.added]
+        removed = diff.removed
+
+    meta = {
+        "source_hash": source_hash,
+        "branches": normalize_branches(BRANCHES),
+        "updated_at": updated_at,
+    }
+    shop_db.write(rows, removed, meta, replace=diff is None)
+
+
+def update_table(old, records, hashes, keys, diff, updated_at):
+    """Новая версия таблицы: переиспользует неизменённые записи и ответы,
+    индекс поиска обновляется только по изменившимся ММ.
+
+    Удалённые ММ оставляют пустые позиции, новые добавляются в конец —
+    так позиции остальных ММ (и индекс по ним) остаются в силе.
+    """
+    new_records = list(old.records)
+    new_replies = list(old.replies)
+    new_hashes = list(old.hashes)
+    removed = set(diff.removed)
+    new_keys = {key: pos for key, pos in old.keys.items() if pos not in removed}
+    replaced = {}
+
+    for pos in diff.removed:
+        new_records[pos] = new_replies[pos] = new_hashes[pos] = None
+
+    def put(pos, i):
+        rec = records[i]
+        new_records[pos] = rec
+        new_replies[pos] = (render_short(rec), render_full(rec))
+        new_hashes[pos] = hashes[i]
+        new_keys[keys[i]] = pos
+        replaced[pos] = rec.shop
+
+    for pos, i in diff.modified:
+        put(pos, i)
+    for i in diff.added:
+        new_records.append(None)
+        new_replies.append(None)
+        new_hashes.append(None)
+        put(len(new_records) - 1, i)
+
+    return ShopTable(
+        records=new_records,
+        replies=new_replies,
+        hashes=new_hashes,
+        keys=new_keys,
+        index=old.index.updated(diff.removed, replaced),
+        fuzzy=old.fuzzy.updated(diff.removed, replaced),
+        fields=update_field_index(old.fields, old.records, new_records, [*diff.removed, *replaced]),
+        updated_at=updated_at,
+    )
 
-def split_text(text: str, max_len: int):
-    """Разбиваем текст на строки для наклейки"""
-    words = text.split()
-    lines = []
-    current = ""
-    for w in words:
-        if len(current) + len(w) + 1 <= max_len:
-            current += (" " if current else "") + w
-        else:
-            lines.append(current)
-            current = w
-    if current:
-        lines.append(current)
-    return lines
 
 def load_table():
-    global df
+    global current_table
     print("📥 Попытка загрузки data.xlsx...")
     start_time = time.time()
     try:
-        tmp = pd.read_excel("data.xlsx")
-        tmp.columns = tmp.columns.str.lower().str.strip()
-        print(f"📄 Файл загружен. Колонки: {tmp.columns.tolist()}")
+        source_hash = file_hash(DATA_FILE)
+        if shop_db is not None:
+            if shop_db.source() == (source_hash, normalize_branches(BRANCHES)):
+                current_table = shop_db
+                remember_start_version(source_hash)
+                print(f"⚡ База ММ {DB_FILE} актуальна: {len(shop_db)} строк")
+                return
+        else:
+            snapshot = load_snapshot(SNAPSHOT_FILE, source_hash, BRANCHES)
+            if snapshot is not None:
+                current_table, _ = snapshot
+                remember_start_version(source_hash)
+                print(f"⚡ Загружен снимок таблицы: {len(current_table)} строк")
+                return
 
-        missing_columns = [col for col in REQUIRED_COLUMNS if col not in tmp.columns]
-        if missing_columns:
-            print(f"❌ Ошибка: отсутствуют обязательные колонки: {missing_columns}")
+        filtered, error = load_excel(DATA_FILE, BRANCHES)
+        if error:
+            print(f"❌ Ошибка: {error}")
             print("❌ Файл не обновлён.")
             return
 
-        allowed_branches = ["уфа восток", "уфа запад"]
-        filtered = tmp[tmp["филиал"].astype(str).str.lower().str.strip().isin(allowed_branches)]
-
-        if filtered.empty:
-            print("⚠ Внимание: нет строк с Филиал = 'Уфа Восток'. Таблица не обновлена.")
+        print(f"✔ Загружено ММ после фильтра по филиалам: {len(filtered)} строк")
+        mtime = os.path.getmtime(DATA_FILE)
+        updated_at = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")
+        records, hashes = build_records(filtered)
+        del filtered
+        if shop_db is not None:
+            write_shop_db(records, hashes, record_keys(records), None, updated_at, source_hash)
+            current_table = shop_db
         else:
-            print(f"✔ Загружено ММ после фильтра по филиалам: {len(filtered)} строк")
-            df = filtered
+            current_table = build_table(records, hashes, updated_at)
+            save_snapshot(SNAPSHOT_FILE, current_table, source_hash, BRANCHES, updated_at)
+        remember_start_version(source_hash)
 
     except FileNotFoundError:
         print("❌ Файл data.xlsx не найден. Таблица пуста.")
@@ -198,6 +572,42 @@ def load_table():
 
 
 
+def remember_start_version(source_hash):
+    """Таблица, загруженная при старте, — текущая версия для /rollback.
+
+    Если data.xlsx тот же, что у текущей версии до перезапуска, история
+    продолжается с неё; иначе (файл заменили вручную) старт даёт новую версию.
+    """
+    version = versions.current
+    if version is not None and version.source_hash == source_hash:
+        version.table = current_table
+        return
+    versions.add(DatasetVersion(
+        current_table, source_hash, current_table.updated_at, "при старте", len(current_table),
+    ), DATA_FILE)
+
+
+def build_version_table(version):
+    """Собирает таблицу версии из её файла — после перезапуска; в рабочем потоке"""
+    filtered, error = load_excel(version.path, BRANCHES)
+    if error:
+        raise ValueError(error)
+    records, hashes = build_records(filtered)
+    return build_table(records, hashes, version.updated_at)
+
+
+def restore_source(version):
+    """Записывает data.xlsx, снимок и список версий после отката, чтобы он пережил перезапуск.
+
+    data.xlsx перезаписывается на месте, а не заменяется: в контейнере это
+    смонтированный файл.
+    """
+    shutil.copyfile(version.path, DATA_FILE)
+    versions.save()
+    if shop_db is None:
+        save_snapshot(SNAPSHOT_FILE, version.table, version.source_hash, BRANCHES, version.updated_at)
+
+
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = update.effective_user
@@ -254,12 +664,80 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("❌ У вас нет прав.")
+
+    shops = current_table
+    table = f"📊 ММ в таблице: {len(shops)}" if shops is not None else "📊 Таблица пуста"
+    await update.message.reply_text(f"{table}\n{describe_startup()}\n{metrics.report()}")
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update.effective_user.id):
         return await update.message.reply_text("⛔ У вас нет доступа к данным.")
     await update.message.reply_text("Бот активирован и слушает.")
 
 
+def describe_changes(title, names, limit=10):
+    text = f"{title}: {len(names)}"
+    if names:
+        text += " — " + ", ".join(names[:limit])
+        if len(names) > limit:
+            text += f" и ещё {len(names) - limit}"
+    return text
+
+
+def ingest_upload(path, old_table, origin):
+    """Читает и проверяет загруженный Excel; выполняется в рабочем потоке.
+
+    Только проверенный файл копируется в data.xlsx. Возвращает текст ответа
+    и новую версию таблицы (None, если таблица не меняется).
+    """
+    try:
+        temp_df, error = load_excel(path, BRANCHES)
+    except Exception as e:
+        return f"❌ Ошибка чтения Excel: {e}", None
+    if error:
+        return f"❌ {error}", None
+
+    records, hashes = build_records(temp_df)
+    del temp_df
+    keys = record_keys(records)
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+    source_hash = file_hash(path)
+
+    diff = None
+    if old_table is not None:
+        old = old_table.fingerprint()
+        diff = diff_table(old, keys, hashes)
+        if not diff:
+            return "ℹ️ Данные не изменились. Таблица не обновлялась.", None
+
+    if shop_db is not None:
+        write_shop_db(records, hashes, keys, diff, updated_at, source_hash)
+        new_table = shop_db
+    else:
+        holes = 0 if diff is None else len(old_table.records) - len(old_table) + len(diff.removed)
+        if diff is None or holes > len(keys) // 4:
+            # первая загрузка или слишком много пустых позиций — собираем таблицу в порядке файла
+            new_table = build_table(records, hashes, updated_at)
+        else:
+            new_table = update_table(old_table, records, hashes, keys, diff, updated_at)
+        save_snapshot(SNAPSHOT_FILE, new_table, source_hash, BRANCHES, updated_at)
+    shutil.copyfile(path, DATA_FILE)
+
+    reply = ["✅ Таблица обновлена!", f"📊 Количество ММ: {len(records)}"]
+    if diff is not None:
+        old_names = {pos: name for pos, _, name in old.values()}
+        reply += [
+            describe_changes("➕ Добавлено", [records[i].shop for i in diff.added]),
+            describe_changes("➖ Удалено", [old_names[pos] for pos in diff.removed]),
+            describe_changes("✏️ Изменено", [records[i].shop for _, i in diff.modified]),
+        ]
+    return "\n".join(reply), DatasetVersion(new_table, source_hash, updated_at, origin, len(records))
+
+
 async def \
         update_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -280,62 +758,200 @@ async def \
     if not document.file_name.lower().endswith(".xlsx"):
         return await update.message.reply_text("❌ Требуется Excel (.xlsx) файл.")
 
-    file = await document.get_file()
-    await file.download_to_drive("data.xlsx")
+    global current_table
+
+    # один файл за раз: пока идёт разбор, запросы обслуживаются по старой таблице
+    async with ingest_lock:
+        file = await document.get_file()
+        await file.download_to_drive(UPLOAD_FILE)
+        await update.message.reply_text("⏳ Файл получен, обрабатываю...")
+
+        origin = f"{document.file_name} от {user.full_name}"
+        try:
+            with metrics.timer("ingest"):
+                reply, version = await asyncio.to_thread(ingest_upload, UPLOAD_FILE, current_table, origin)
+            if version is not None:
+                await asyncio.to_thread(versions.add, version, UPLOAD_FILE)
+                current_table = version.table
+        finally:
+            os.remove(UPLOAD_FILE)
+
+    if version is not None and shop_db is None:
+        reply += f"\n🗂 Версия {version.number}, откат — /rollback"
+    await update.message.reply_text(reply)
+
+
+def describe_version(version):
+    marker = "▶" if version is versions.current else "•"
+    return (
+        f"{marker} {version.number}. {version.updated_at} — {version.shops} ММ "
+        f"({version.origin})"
+    )
 
-    try:
-        temp_df = pd.read_excel("data.xlsx")
-    except Exception as e:
-        return await update.message.reply_text(f"❌ Ошибка чтения Excel: {e}")
-
-    temp_df.columns = [str(c).strip().lower() for c in temp_df.columns]
-
-    required_cols = {
-        "код",
-        "магазин",
-        "статус",
-        "тип",
-        "фио системотехника",
-        "телефон системотехника",
-        "филиал",
-    }
 
-    missing = required_cols - set(temp_df.columns)
-    if missing:
-        return await update.message.reply_text(
-            f"❌ Нет обязательных столбцов: {', '.join(missing)}"
-        )
+async def versions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("❌ У вас нет прав.")
+    if not versions:
+        return await update.message.reply_text("📊 Таблица пуста")
+
+    lines = ["🗂 Версии таблицы (▶ — текущая):"]
+    lines += [describe_version(v) for v in reversed(versions.versions)]
+    if shop_db is None:
+        lines.append("\nВернуть версию: /rollback <номер>")
+    else:
+        lines.append("\nС storage = \"sqlite\" хранится только текущая версия.")
+    await update.message.reply_text("\n".join(lines))
 
-    temp_df = temp_df[temp_df["филиал"].isin(["Уфа Восток", "Уфа Запад"])]
 
-    if temp_df.empty:
+async def rollback_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("❌ У вас нет прав.")
+    if shop_db is not None:
         return await update.message.reply_text(
-            "❌ В файле нет строк с филиалами Уфа Восток или Уфа Запад."
+            "⚠ Откат доступен только с storage = \"memory\": shops.db меняется на месте."
         )
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        return await update.message.reply_text("Использование: /rollback <номер>, список — /versions")
 
-    temp_df = temp_df.reset_index(drop=True)
+    version = versions.get(int(context.args[0]))
+    if version is None:
+        return await update.message.reply_text("❌ Нет такой версии. Список: /versions")
+    if version is versions.current:
+        return await update.message.reply_text("ℹ Эта версия уже используется.")
 
-    global df
+    global current_table
 
-    if df is not None:
-        if (
-            len(df) == len(temp_df)
-            and set(df.columns) == set(temp_df.columns)
-            and df.sort_values(list(df.columns)).reset_index(drop=True)
-            .equals(
-                temp_df.sort_values(list(temp_df.columns)).reset_index(drop=True)
-            )
-        ):
-            return await update.message.reply_text(
-                "ℹ️ Данные не изменились. Таблица не обновлялась."
-            )
-
-    df = temp_df
+    # под тем же замком, что и загрузка: откат не смешается с разбором нового файла
+    async with ingest_lock:
+        if version.table is None:
+            try:
+                version.table = await asyncio.to_thread(build_version_table, version)
+            except Exception as e:
+                return await update.message.reply_text(f"❌ Не удалось собрать версию {version.number}: {e}")
+        start = time.perf_counter()
+        versions.switch(version)
+        current_table = version.table
+        elapsed = time.perf_counter() - start
+        await asyncio.to_thread(restore_source, version)
+
+    print(f"↩️ {update.effective_user.full_name} вернул версию таблицы {version.number}")
     await update.message.reply_text(
-        f"✅ Таблица обновлена!\n📊 Количество ММ: {len(df)}"
+        f"↩️ Возвращена версия {version.number}: {version.shops} ММ, "
+        f"выгрузка от {version.updated_at} (переключение {elapsed * 1000:.3f} мс)"
+    )
+
+
+# ранги совпадений: в ответе сначала полные названия, потом частичные, потом нечёткие
+MATCH_FULL, MATCH_PARTIAL, MATCH_FUZZY = range(3)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+CODE_RE = re.compile(r"\bкод (\d+)")
+TECH_LIST_RE = re.compile(r"\b(?:магазины|ммы|мм|точки) у ")
+TECH_PAGE_SIZE = 20
+# листаемые списки ММ: номер -> (вид, ключи). В callback_data (до 64 байт) идёт
+# только номер — несколько фамилий кириллицей туда не помещаются
+TECH_QUERIES_LIMIT = 1000
+tech_queries = {}
+tech_query_seq = 0
+
+
+def message_stems(msg_norm):
+    return {name_stem(w) for w in msg_norm.split() if len(w) >= 4}
+
+
+def find_tech_shops(shops, kind, keys):
+    return shops.find_phone(keys) if kind == "p" else shops.find_tech(keys)
+
+
+def describe_tech_shops(records, page):
+    """Страница списка ММ системотехника(ов) и число страниц"""
+    pages = (len(records) + TECH_PAGE_SIZE - 1) // TECH_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    techs = dict.fromkeys(f"{rec.tech} {rec.tech_phone}" for rec in records)
+
+    lines = [f"👤 {', '.join(techs)} — ММ: {len(records)}"]
+    for rec in records[page * TECH_PAGE_SIZE:(page + 1) * TECH_PAGE_SIZE]:
+        status_text = f"<b>{rec.status}</b>" if rec.status.lower() == "закрыт" else rec.status
+        lines.append(f"• {rec.shop} {rec.mm_type} ({rec.code}) {status_text}")
+    if pages > 1:
+        lines.append(f"Стр. {page + 1}/{pages}")
+    return "\n".join(lines), page, pages
+
+
+def remember_tech_query(kind, keys):
+    """Номер листаемого списка для callback_data; самые старые списки вытесняются"""
+    global tech_query_seq
+    tech_query_seq += 1
+    tech_queries[tech_query_seq] = (kind, frozenset(keys))
+    if len(tech_queries) > TECH_QUERIES_LIMIT:
+        del tech_queries[next(iter(tech_queries))]
+    return tech_query_seq
+
+
+def tech_page_markup(query_id, page, pages):
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"techs:{query_id}:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"techs:{query_id}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def reply_tech_shops(update, shops, kind, keys):
+    """Отвечает списком ММ по фамилии (kind "t") или телефону ("p"); False, если ничего нет"""
+    records = find_tech_shops(shops, kind, keys) if keys else []
+    if not records:
+        return False
+    text, page, pages = describe_tech_shops(records, 0)
+    markup = tech_page_markup(remember_tech_query(kind, keys), page, pages) if pages > 1 else None
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+    return True
+
+
+async def tech_shops_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not is_allowed(query.from_user.id):
+        return await query.answer("⛔ У вас нет доступа к данным.")
+
+    _, query_id, page = query.data.split(":")
+    # после перезапуска или вытеснения списка уже нет
+    kind, keys = tech_queries.get(int(query_id), (None, None))
+    shops = current_table
+    records = find_tech_shops(shops, kind, keys) if kind and shops is not None else []
+    if not records:
+        return await query.answer("Список устарел, спросите ещё раз")
+
+    text, page, pages = describe_tech_shops(records, int(page))
+    await query.answer()
+    await query.edit_message_text(
+        text, parse_mode="HTML", reply_markup=tech_page_markup(query_id, page, pages)
     )
 
 
+def batch_messages(parts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Склеивает ответы в как можно меньше сообщений не длиннее limit"""
+    batch = ""
+    for part in parts:
+        if batch and len(batch) + 2 + len(part) > limit:
+            yield batch
+            batch = ""
+        batch = f"{batch}\n\n{part}" if batch else part
+    if batch:
+        yield batch
+
+
+def describe_choices(choices):
+    limit = FUZZY["max_choices"]
+    lines = ["🤔 Уточните, какой ММ:"]
+    lines += [f"• {rec.shop} {rec.mm_type} ({rec.code})" for rec, *_ in choices[:limit]]
+    if len(choices) > limit:
+        lines.append(f"и ещё {len(choices) - limit}")
+    return "\n".join(lines)
+
 
 async def listen_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
@@ -343,6 +959,7 @@ async def listen_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
     text_raw = update.message.text
+    metrics.inc("messages")
 
     #print(f"[CHAT:{chat.title if chat.title else chat.id}] {user.full_name} ({user.id}): {text_raw}")
 
@@ -350,10 +967,12 @@ async def listen_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(f"⛔ Доступ запрещён: {user.full_name} ({user.id})")
         return
 
-    if df.empty:
+    shops = current_table
+    if shops is None:
         print("⚠ Таблица пуста — пропускаю обработку")
         return
 
+    match_started = time.perf_counter()
     msg_norm = norm(text_raw)
 
     is_question = msg_norm.startswith("чей ") or msg_norm.startswith("какой ") or msg_norm.startswith("кто ")
@@ -363,123 +982,117 @@ async def listen_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     use_partial = is_question or bot_mentioned or reply_to_bot
 
-    for _, row in df.iterrows():
-        mm_raw = str(row["магазин"]).strip()
-        mm_norm = norm(mm_raw)
-        mm_words = mm_norm.split()
+    # найденные ММ: (ранг MATCH_*, начало в сообщении, hit)
+    matches = []
+    code_match = CODE_RE.search(msg_norm)
+    if code_match:
+        hit = shops.find_code(code_match.group(1))
+        if hit is not None:
+            matches.append((MATCH_FULL, -1, hit))
+
+    # «какие магазины у Иванова» — список ММ системотехника
+    if not matches and TECH_LIST_RE.search(msg_norm):
+        if await reply_tech_shops(update, shops, "t", message_stems(msg_norm)):
+            return
 
-        found = False
+    # к боту обратились с телефоном — чьи это ММ
+    if not matches and use_partial:
+        phones = phone_keys(text_raw)
+        if phones and await reply_tech_shops(update, shops, "p", phones):
+            return
 
-        if re.search(rf"\b{re.escape(mm_norm)}\b", msg_norm):
-            found = True
+    covered = set()
+    for start, n, full, hit in shops.lookup_all(msg_norm, use_partial):
+        matches.append((MATCH_FULL if full else MATCH_PARTIAL, start, hit))
+        covered.update(range(start, start + n))
 
-        elif use_partial:
-            if any(re.search(rf"\b{re.escape(w)}\b", msg_norm) for w in mm_words):
-                found = True
+    # к боту обратились, а названия нет: может, это фамилия системотехника
+    if not matches and use_partial:
+        if await reply_tech_shops(update, shops, "t", message_stems(msg_norm)):
+            return
 
-        if not found:
-            continue
+    # нечёткий поиск — только когда обращаются к боту (иначе «удачи всем» находит «Удачу»)
+    # и только по словам, которые точный не разобрал
+    ambiguous = []
+    if FUZZY["enabled"] and use_partial:
+        for start, _, hits in shops.suggest(text_raw, use_partial, FUZZY["max_distance"], covered):
+            if len(hits) == 1:
+                matches.append((MATCH_FUZZY, start, hits[0]))
+            else:
+                ambiguous.append(hits)
 
-        FULL_REPORT_KEYWORDS = ["полный отчет", "полностью", "отчет", "информация", "инфо", "статус"]
-        full_report = any(k in msg_norm for k in FULL_REPORT_KEYWORDS)
+    metrics.observe("match", time.perf_counter() - match_started)
+    if not matches and not ambiguous:
+        return
 
-        # 🔒 Лимит ТОЛЬКО для обычных запросов
-        if not full_report:
-            now = datetime.now()
-            last_time = last_response_time.get(mm_norm)
-            if last_time and now - last_time < timedelta(hours=1):
-                print(f"⏳ Ограничение: уже отвечал по {mm_raw}")
-                return
-            last_response_time[mm_norm] = now
+    FULL_REPORT_KEYWORDS = ["полный отчет", "полностью", "отчет", "информация", "инфо", "статус"]
+    full_report = any(k in msg_norm for k in FULL_REPORT_KEYWORDS)
 
-        branch = str(row.get("филиал", "-")).strip()
-        branch_suffix = f" ! {branch}" if branch.lower() == "уфа запад" else ""
+    replies = []
+    seen = set()
+    skipped = 0
+    matches.sort(key=lambda m: m[:2])
+    for rank, _, (rec, mm_norm, short_reply, full_reply) in matches:
+        # ММ, упомянутый в сообщении дважды, проверяется и считается один раз
+        if mm_norm in seen:
+            continue
+        seen.add(mm_norm)
+        if len(replies) == REPLIES["max_matches"]:
+            skipped += 1
+            continue
 
-        phone_val = row.get("телефон системотехника")
-        if pd.notna(phone_val):
-            try:
-                phone = str(int(phone_val))
-            except:
-                phone = str(phone_val)
-        else:
-            phone = "-"
+        # 🔒 Лимит на (чат, ММ); полный отчёт по умолчанию без лимита
+        if not (full_report and RATE_LIMIT["full_report_exempt"]):
+            if not rate_limiter.allow(chat.id, mm_norm):
+                print(f"⏳ Ограничение: уже отвечал по {rec.shop}")
+                metrics.inc("rate_limited")
+                continue
 
         if full_report:
-            def safe(v):
-                return "-" if pd.isna(v) else str(v)
-
-            shop = safe(row.get("магазин"))
-            mm_type = safe(row.get("тип"))
-            stst = safe(row.get("статус"))
-            code = safe(row.get("код"))
-            format_mm = safe(row.get("формат"))
-            branch = safe(row.get("филиал"))
-            open_date = safe(row.get("дата открытия"))
-            close_date = safe(row.get("дата закрытия"))
-            email = safe(row.get("email"))
-            tech = safe(row.get("фио системотехника"))
-
-            phone_val = row.get("телефон системотехника")
-            if pd.notna(phone_val):
-                try:
-                    tech_phone = str(int(phone_val))
-                except:
-                    tech_phone = str(phone_val)
-            else:
-                tech_phone = "-"
-
-            address = safe(row.get("полный адрес"))
-
-            reply_lines = [
-                f"Магазин: {mm_type} {shop} ({code})",
-                f"Формат: {format_mm}",
-                f"Статус: {stst}",
-                f"Филиал: {branch}",
-                f"Дата открытия: {open_date}",
-                f"Дата закрытия: {close_date}",
-                f"Email: {email}",
-                f"ФИО системотехника: {tech} ({tech_phone})",
-                f"Полный адрес: {address}",
-            ]
-
-            try:
-                mtime = os.path.getmtime("data.xlsx")
-                update_time = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")
-                reply_lines.append(f"Дата обновления выгрузки: {update_time}")
-            except:
-                reply_lines.append("Дата обновления выгрузки: неизвестна")
-
-            reply = "\n".join(reply_lines)
-
+            reply = f"{full_reply}\nДата обновления выгрузки: {shops.updated_at or 'неизвестна'}"
         else:
-            name = row.get("магазин", "-")
-            mm_type = row.get("тип", "-")
-            code = row.get("код", "-")
-            status = row.get("статус", "-")
-            tech = row.get("фио системотехника", "-")
-
-            status_text = f"<b>{status}</b>" if status.lower() == "закрыт" else status
+            reply = short_reply
+        if rank == MATCH_FUZZY:
+            reply = f"🔎 Похоже, речь о «{rec.shop}»:\n{reply}"
+        replies.append(reply)
 
-            line1 = f"{name} {mm_type} ({code}) {status_text}{branch_suffix}"
-            line2 = f"{tech} {phone}"
-            reply = f"{line1}\n{line2}"
+    metrics.inc("matches", len(replies))
+    if skipped:
+        replies.append(f"…и ещё ММ: {skipped}. Уточните запрос.")
+    replies += [describe_choices(hits) for hits in ambiguous]
 
-       # print(f"✅ Бот отвечает на ММ: {mm_raw} (полный отчёт: {full_report})")
-        await update.message.reply_text(reply, parse_mode="HTML")
-        return
+    for text in batch_messages(replies):
+        with metrics.timer("reply"):
+            await update.message.reply_text(text, parse_mode="HTML")
 
 
 async def label_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     lines = update.message.text.strip().split("\n")
     user = update.effective_user
+    labels = await get_labels()
+
+    args = lines[0].split()[1:]
+    layout_name = args[0].lower() if args else "label"
+    if layout_name in labels.LABEL_LAYOUTS:
+        args = args[1:]
+    else:
+        layout_name = "label"
+    layout = labels.LABEL_LAYOUTS[layout_name]
 
-    if len(lines) < 2:
+    # 🔹 /label филиал=... — наклейки на ММ из загруженной таблицы
+    if "=" in " ".join(args):
+        return await bulk_labels(update, " ".join(args), layout)
+
+    if len(lines) < 2 or args:
         await update.message.reply_text(
             "❌ Формат:\n"
             "/label\n"
             "0000000907115 Ажур Стационарный сканер ШК 2D (сканирует QR)\n"
-            "0000000555631 Ажур Ручной сканер ШК 2D (сканирует QR)"
+            "0000000555631 Ажур Ручной сканер ШК 2D (сканирует QR)\n\n"
+            "/label a4 — те же наклейки сеткой на листах A4\n"
+            "/label филиал=Уфа Восток — наклейки на все ММ филиала; "
+            "также техник=, статус=, тип= (можно сочетать)"
         )
         return
 
@@ -494,95 +1107,169 @@ async def label_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ Ошибка в строке:\n{line}")
             return
         code, shop, name = parts
-        items.append((code.strip(), shop.strip(), name.strip()))
+        items.append((code.strip(), name.strip()))
         shops.add(shop.strip())
 
     if not items:
         await update.message.reply_text("❌ Нет данных для генерации")
         return
 
-    tmp_dir = tempfile.gettempdir()
-    pdf_path = os.path.join(tmp_dir, "labels.pdf")
-    c = canvas.Canvas(pdf_path, pagesize=(60 * mm, 30 * mm))
-
-    # 🔹 Если есть один магазин, делаем наклейку с названием магазина
-    if len(shops) == 1:
-        shop_name = list(shops)[0]
-        c.setFont("DejaVu", 10)
-        c.drawCentredString(30 * mm, 15 * mm, shop_name)
-        c.showPage()
-
-    # 🔹 Генерация наклеек для каждой КЕ
-    for code, shop, name in items:
-        barcode_base = os.path.join(tmp_dir, code)
-        barcode_png = barcode_base + ".png"
-
-        # Функция генерации PNG штрихкода
-        generate_barcode(code, barcode_base)
-
-        img = ImageReader(barcode_png)
-
-        # штрихкод
-        c.drawImage(
-            img,
-            5 * mm,
-            8 * mm,
-            width=50 * mm,
-            height=15 * mm,
-            preserveAspectRatio=True,
-            mask="auto"
-        )
+    shop_name = next(iter(shops)) if len(shops) == 1 else None
+    filename = f"{shop_name or 'labels'}.pdf"
 
-        # код под штрихкодом
-        c.setFont("DejaVu", 7)
-        c.drawCentredString(30 * mm, 6 * mm, code)
+    if label_slots.locked():
+        await update.message.reply_text("⏳ Генерация наклеек в очереди, подождите...")
 
-        # название КЕ, центрируем
-        text_obj = c.beginText()
-        text_obj.setFont("DejaVu", 6)
-        text_lines = split_text(name, 28)
-        y_start = 26 * mm  # верхний отступ
-        for i, line in enumerate(text_lines):
-            # ширина строки в точках
-            text_width = c.stringWidth(line, "DejaVu", 6)
-            # координата x = центр наклейки
-            x = (60 * mm - text_width) / 2
-            y = y_start - i * 5 * mm
-            c.drawString(x, y, line)
-        c.drawText(text_obj)
+    async with label_slots:
+        loop = asyncio.get_running_loop()
+        with metrics.timer("label_render"):
+            pdf = await loop.run_in_executor(
+                label_executor, labels.render_labels, items, shop_name, layout
+            )
 
-        c.showPage()  # новая наклейка
+    await update.message.reply_document(
+        document=io.BytesIO(pdf),
+        filename=filename
+    )
+    print(f"Генерация КЕ файл {filename} от {user.full_name} ({user.id}).")
+
+
+# лимит Telegram на отправку файла ботом
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+
+# ключ фильтра в /label -> поле ShopRecord
+LABEL_FILTERS = {
+    "филиал": "branch",
+    "техник": "tech",
+    "системотехник": "tech",
+    "статус": "status",
+    "тип": "mm_type",
+}
+
+
+def parse_label_filters(text):
+    """'филиал=Уфа Восток статус=открыт' -> {'branch': 'уфа восток', 'status': 'открыт'}"""
+    filters_ = {}
+    for key, value in re.findall(r"(\S+?)=(.*?)(?=\s+\S+=|$)", text.strip()):
+        field = LABEL_FILTERS.get(key.lower())
+        if field is None or not norm(value):
+            return None
+        filters_[field] = norm(value)
+    return filters_ or None
+
+
+def select_shops(table, filters_):
+    """ММ таблицы, подходящие под все фильтры; техник ищется по словам ФИО"""
+    result = []
+    for rec in table.iter_records():
+        for field, value in filters_.items():
+            actual = norm(getattr(rec, field))
+            if field == "tech":
+                if not set(value.split()) <= set(actual.split()):
+                    break
+            elif actual != value:
+                break
+        else:
+            result.append(rec)
+    return result
 
-        if os.path.exists(barcode_png):
-            os.remove(barcode_png)
 
-    c.save()
+async def bulk_labels(update: Update, query, layout):
+    user = update.effective_user
+    if not is_allowed(user.id):
+        return await update.message.reply_text("⛔ У вас нет доступа к данным.")
 
-    await update.message.reply_document(
-        document=open(pdf_path, "rb"),
-        filename=shop_name+'.pdf'
-    )
-    print(f"Генерация КЕ файл {shop_name+'.pdf'} от {user.full_name} ({user.id}).")
+    filters_ = parse_label_filters(query)
+    if filters_ is None:
+        return await update.message.reply_text(
+            f"❌ Не понял фильтр. Доступно: {', '.join(LABEL_FILTERS)}"
+        )
+
+    shops = current_table
+    selected = select_shops(shops, filters_) if shops is not None else []
+    if not selected:
+        return await update.message.reply_text("❌ Нет ММ под этот фильтр")
+
+    items = [(rec.code, f"{rec.mm_type} {rec.shop}") for rec in selected]
+    await update.message.reply_text(f"⏳ Наклеек: {len(items)}, готовлю PDF...")
+
+    loop = asyncio.get_running_loop()
+    documents = labels.render_label_documents(items, layout, TELEGRAM_FILE_LIMIT)
+    part = 0
+    while True:
+        # слот берётся на каждую часть, чтобы большие выгрузки не занимали пул целиком
+        async with label_slots:
+            started = time.perf_counter()
+            pdf = await loop.run_in_executor(label_executor, next, documents, None)
+        if pdf is None:
+            break
+        metrics.observe("label_render", time.perf_counter() - started)
+        part += 1
+        await update.message.reply_document(
+            document=io.BytesIO(pdf),
+            filename=f"labels_{part}.pdf"
+        )
+
+    print(f"Генерация наклеек ММ ({query}): {len(items)} шт., {part} файл(ов) "
+          f"от {user.full_name} ({user.id}).")
+
+
+async def post_init(app):
+    startup_phase("Telegram")
+    print(describe_startup())
+    # модуль наклеек грузится в фоне, пока бот уже отвечает в чатах
+    asyncio.get_running_loop().run_in_executor(label_executor, load_labels)
 
-    os.remove(pdf_path)
 
 def main():
     print("Старт бота...")
+    versions.load()
     load_table()
-    if df.empty:
+    if current_table is None:
         print("Таблица пуста. Загрузите Excel файл.")
-
-    app = ApplicationBuilder().token(TOKEN).build()
+    startup_phase("таблица")
+
+    if METRICS["port"]:
+        serve_prometheus(metrics, METRICS["host"], METRICS["port"])
+        print(f"📈 Метрики: http://{METRICS['host']}:{METRICS['port']}/metrics")
+
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(ChatOrderedProcessor(TELEGRAM["concurrent_updates"]))
+        .connection_pool_size(TELEGRAM["connection_pool_size"])
+        .pool_timeout(TELEGRAM["pool_timeout"])
+        .post_init(post_init)
+    )
+    if TELEGRAM["base_url"]:
+        builder.base_url(TELEGRAM["base_url"])
+    if TELEGRAM["base_file_url"]:
+        builder.base_file_url(TELEGRAM["base_file_url"])
+    app = builder.build()
 
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler("listusers", list_users))
     app.add_handler(CommandHandler("adduser", add_user))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("versions", versions_cmd))
+    app.add_handler(CommandHandler("rollback", rollback_cmd))
     app.add_handler(CommandHandler("label", label_cmd))
+    app.add_handler(CallbackQueryHandler(tech_shops_page, pattern=r"^techs:"))
     app.add_handler(MessageHandler(filters.Document.ALL, update_excel))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, listen_chat))
 
-    print("Бот запущен.")
-    app.run_polling()
+    if WEBHOOK["url"]:
+        print(f"Бот запущен (вебхук {WEBHOOK['url']}, порт {WEBHOOK['port']}).")
+        app.run_webhook(
+            listen=WEBHOOK["listen"],
+            port=WEBHOOK["port"],
+            url_path=WEBHOOK["path"],
+            webhook_url=f"{WEBHOOK['url'].rstrip('/')}/{WEBHOOK['path']}",
+            secret_token=WEBHOOK["secret_token"],
+        )
+    else:
+        print("Бот запущен.")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,47 @@
+"""Списки позиций ММ для индексов поиска с дешёвыми версиями при загрузке выгрузки."""
+import bisect
+
+
+class Postings(dict):
+    """Ключ -> позиции ММ по возрастанию.
+
+    Индексы (MatchIndex, FieldIndex, FuzzyIndex) обновляются по разнице
+    выгрузок, а прежняя версия индекса продолжает отвечать — и хранится для
+    /rollback. version() даёт новую версию, которая делит списки со старой;
+    add и discard копируют список при первой записи, так что старая не меняется.
+    """
+
+    __slots__ = ("_own",)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._own = None   # ключи, чьи списки уже скопированы; None — версия не делит списки или собрана
+
+    def version(self):
+        new = Postings(self)
+        new._own = set()
+        return new
+
+    def seal(self):
+        """Версия собрана: дальше её списки только читаются"""
+        self._own = None
+
+    def _writable(self, key):
+        rows = self.get(key)
+        if rows is None:
+            rows = self[key] = []
+        elif self._own is not None and key not in self._own:
+            rows = self[key] = list(rows)
+        if self._own is not None:
+            self._own.add(key)
+        return rows
+
+    def add(self, key, pos):
+        bisect.insort(self._writable(key), pos)
+
+    def discard(self, key, pos):
+        """Убирает позицию; опустевший ключ удаляется"""
+        rows = self._writable(key)
+        rows.remove(pos)
+        if not rows:
+            del self[key]
@@ -0,0 +1,78 @@
+"""Ограничение частоты ответов бота: не чаще раза за окно на пару (чат, ММ)."""
+import heapq
+import sqlite3
+import time
+
+
+class RateLimiter:
+    """Помнит время последнего ответа по ключу (chat_id, магазин).
+
+    Устаревшие ключи удаляются по куче сроков, так что память не растёт
+    со временем. Если задан path, времена хранятся ещё и в SQLite и
+    переживают перезапуск контейнера.
+    """
+
+    def __init__(self, window, path=None):
+        self.window = window
+        self._last = {}       # (chat_id, магазин) -> время последнего ответа
+        self._expiry = []     # куча (срок, ключ)
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS last_response ("
+                " chat_id INTEGER NOT NULL,"
+                " shop TEXT NOT NULL,"
+                " answered_at REAL NOT NULL,"
+                " PRIMARY KEY (chat_id, shop))"
+            )
+            now = time.time()
+            self._db.execute("DELETE FROM last_response WHERE answered_at <= ?", (now - window,))
+            self._db.commit()
+            for chat_id, shop, answered_at in self._db.execute(
+                "SELECT chat_id, shop, answered_at FROM last_response"
+            ):
+                self._remember((chat_id, shop), answered_at)
+
+    def __len__(self):
+        return len(self._last)
+
+    def _remember(self, key, now):
+        self._last[key] = now
+        heapq.heappush(self._expiry, (now + self.window, key))
+
+    def _expire(self, now):
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            last = self._last.get(key)
+            if last is not None and last + self.window <= now:
+                del self._last[key]
+                expired.append(key)
+        if expired and self._db is not None:
+            self._db.executemany(
+                "DELETE FROM last_response WHERE chat_id = ? AND shop = ?", expired
+            )
+            self._db.commit()
+
+    def allow(self, chat_id, shop, now=None):
+        """True, если по этому ММ в этом чате можно ответить, и запоминает ответ"""
+        now = time.time() if now is None else now
+        self._expire(now)
+
+        key = (chat_id, shop)
+        last = self._last.get(key)
+        if last is not None and now - last < self.window:
+            return False
+
+        self._remember(key, now)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO last_response (chat_id, shop, answered_at) VALUES (?, ?, ?)",
+                (chat_id, shop, now),
+            )
+            self._db.commit()
+        return True
@@ -0,0 +1,295 @@
+"""Хранилище ММ в SQLite — альтернатива таблице в памяти (storage = "sqlite" в config.json).
+
+Данные лежат на диске: старт не требует разбора Excel, а память бота не растёт
+с размером выгрузки. Поиск по названию идёт по индексу и FTS5.
+"""
+import json
+import sqlite3
+
+from fuzzy import FuzzyIndex
+from ingest import ShopRecord, norm, phone_keys, scan_names, tech_keys
+
+FIELDS = ShopRecord.__slots__
+# меняется вместе со схемой или norm(): старая база тогда строится заново
+DB_VERSION = 3
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS shops (
+    pos INTEGER PRIMARY KEY,
+    occurrence INTEGER NOT NULL,
+    row_hash INTEGER NOT NULL,
+    {", ".join(f"{f} TEXT" + (" NOT NULL" if f == "code" else "") for f in FIELDS)},
+    name_norm TEXT NOT NULL,
+    n_words INTEGER NOT NULL,
+    address_norm TEXT NOT NULL,
+    branch_norm TEXT NOT NULL,
+    tech_norm TEXT NOT NULL,
+    short_reply TEXT NOT NULL,
+    full_reply TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS shops_key ON shops (code, occurrence);
+CREATE INDEX IF NOT EXISTS shops_name ON shops (name_norm);
+CREATE INDEX IF NOT EXISTS shops_branch ON shops (branch_norm);
+CREATE INDEX IF NOT EXISTS shops_tech ON shops (tech_norm);
+
+-- вторичные ключи ММ: kind "t" — основа слова ФИО системотехника, "p" — телефон
+CREATE TABLE IF NOT EXISTS shop_keys (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shop_keys_key ON shop_keys (kind, key);
+CREATE INDEX IF NOT EXISTS shop_keys_pos ON shop_keys (pos);
+
+-- сколько названий из N слов: по этим длинам режется сообщение при поиске
+CREATE TABLE IF NOT EXISTS name_lengths (
+    n INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS shops_fts USING fts5 (
+    name_norm, address_norm,
+    content = 'shops', content_rowid = 'pos',
+    tokenize = 'unicode61 remove_diacritics 0'
+);
+CREATE TRIGGER IF NOT EXISTS shops_ai AFTER INSERT ON shops BEGIN
+    INSERT INTO shops_fts (rowid, name_norm, address_norm)
+    VALUES (new.pos, new.name_norm, new.address_norm);
+END;
+CREATE TRIGGER IF NOT EXISTS shops_ad AFTER DELETE ON shops BEGIN
+    INSERT INTO shops_fts (shops_fts, rowid, name_norm, address_norm)
+    VALUES ('delete', old.pos, old.name_norm, old.address_norm);
+END;
+CREATE TRIGGER IF NOT EXISTS shops_au AFTER UPDATE ON shops BEGIN
+    INSERT INTO shops_fts (shops_fts, rowid, name_norm, address_norm)
+    VALUES ('delete', old.pos, old.name_norm, old.address_norm);
+    INSERT INTO shops_fts (rowid, name_norm, address_norm)
+    VALUES (new.pos, new.name_norm, new.address_norm);
+END;
+"""
+
+RECORD_SQL = ", ".join(FIELDS)
+HIT_SQL = f"SELECT {RECORD_SQL}, name_norm, short_reply, full_reply FROM shops WHERE pos = ?"
+CODE_SQL = (f"SELECT {RECORD_SQL}, name_norm, short_reply, full_reply FROM shops "
+            f"WHERE code = ? ORDER BY occurrence LIMIT 1")
+DROP_SQL = """
+DROP TABLE IF EXISTS shops_fts;
+DROP TABLE IF EXISTS shops;
+DROP TABLE IF EXISTS shop_keys;
+DROP TABLE IF EXISTS name_lengths;
+DROP TABLE IF EXISTS meta;
+"""
+
+UINT64 = 1 << 64
+
+
+def to_signed(h):
+    # хеши pandas беззнаковые 64-битные, а INTEGER в SQLite — знаковый
+    return h - UINT64 if h >= 1 << 63 else h
+
+
+class ShopDatabase:
+    """ММ в SQLite с тем же интерфейсом поиска, что у ShopTable.
+
+    Читает соединение потока бота; write и fingerprint открывают свои соединения,
+    поэтому их можно вызывать из рабочего потока. Изменения видны читателю
+    только после коммита всей выгрузки (WAL).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        if self._meta("version") != DB_VERSION:
+            # база от другой версии бота: строим заново из data.xlsx
+            self._db.executescript(DROP_SQL + SCHEMA)
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (json.dumps(DB_VERSION),))
+        # FuzzyIndex по названиям: строится при первом нечётком поиске и держит
+        # в памяти все названия — единственное, что растёт с размером выгрузки
+        self.fuzzy = None
+        self._generation = 0   # растёт с каждой записью; устаревший индекс не сохраняется
+
+    def _meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @property
+    def updated_at(self):
+        return self._meta("updated_at")
+
+    def source(self):
+        """(хеш data.xlsx, филиалы), из которых построена база"""
+        return self._meta("source_hash"), self._meta("branches")
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM shops").fetchone()[0]
+
+    def lookup_all(self, msg_norm, use_partial=False):
+        """Как ShopTable.lookup_all: [(начало, слов, полное?, hit)]"""
+        tokens = msg_norm.split()
+        if not tokens:
+            return []
+
+        # одна читающая транзакция — загрузка файла не вклинится между запросами
+        self._db.execute("BEGIN")
+        try:
+            lengths = [n for (n,) in self._db.execute("SELECT n FROM name_lengths ORDER BY n")]
+            grams = {
+                " ".join(tokens[i:i + n])
+                for n in lengths
+                for i in range(len(tokens) - n + 1)
+            }
+            names = {}
+            if grams:
+                names = dict(self._db.execute(
+                    f"SELECT name_norm, MIN(pos) FROM shops "
+                    f"WHERE name_norm IN ({', '.join('?' * len(grams))}) GROUP BY name_norm",
+                    list(grams),
+                ))
+
+            def find_word(word):
+                row = self._db.execute(
+                    "SELECT rowid FROM shops_fts WHERE shops_fts MATCH ? ORDER BY rowid LIMIT 1",
+                    (f'name_norm : "{word}"',),
+                ).fetchone()
+                return row[0] if row else None
+
+            found = scan_names(
+                tokens, lengths, lambda words: names.get(" ".join(words)),
+                find_word if use_partial else None,
+            )
+            result = [
+                (start, n, full, self._hit(self._db.execute(HIT_SQL, (pos,)).fetchone()))
+                for start, n, pos, full in found
+            ]
+        finally:
+            self._db.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _hit(row):
+        return ShopRecord(*row[:len(FIELDS)]), *row[len(FIELDS):]
+
+    def find_code(self, code):
+        """hit первого ММ с этим кодом или None (индекс shops_key)"""
+        row = self._db.execute(CODE_SQL, (code,)).fetchone()
+        return self._hit(row) if row else None
+
+    def find_tech(self, stems):
+        """ММ системотехников, в ФИО которых есть слово с одной из основ"""
+        return self._records_by("t", stems)
+
+    def find_phone(self, phones):
+        """ММ системотехников с одним из телефонов"""
+        return self._records_by("p", phones)
+
+    def _records_by(self, kind, keys):
+        keys = list(keys)
+        rows = self._db.execute(
+            f"SELECT {RECORD_SQL} FROM shops WHERE pos IN ("
+            f"SELECT pos FROM shop_keys WHERE kind = ? AND key IN ({', '.join('?' * len(keys))})"
+            f") ORDER BY pos",
+            [kind, *keys],
+        )
+        return [ShopRecord(*row) for row in rows]
+
+    def _fuzzy_index(self):
+        """Индекс нечёткого поиска по текущим названиям ММ, строится по требованию"""
+        fuzzy = self.fuzzy
+        if fuzzy is None:
+            generation = self._generation
+            fuzzy = FuzzyIndex(self._db.execute("SELECT pos, shop FROM shops ORDER BY pos"))
+            # пока строили, могла закоммититься новая выгрузка — тогда индекс только на этот раз
+            if generation == self._generation:
+                self.fuzzy = fuzzy
+        return fuzzy
+
+    def suggest(self, text, use_partial=False, max_distance=2, covered=frozenset()):
+        """Как ShopTable.suggest: [(начало, слов, [hit кандидатов])]"""
+        result = []
+        fuzzy = self._fuzzy_index()
+        for start, n, positions in fuzzy.matches(text, use_partial, max_distance, covered):
+            rows = [self._db.execute(HIT_SQL, (pos,)).fetchone() for pos in positions]
+            hits = [self._hit(row) for row in rows if row is not None]
+            if hits:
+                result.append((start, n, hits))
+        return result
+
+    def iter_records(self):
+        for row in self._db.execute(f"SELECT {RECORD_SQL} FROM shops ORDER BY pos"):
+            yield ShopRecord(*row)
+
+    def fingerprint(self):
+        """Ключ ММ -> (позиция, хеш строки, название) для сравнения с новой выгрузкой.
+
+        Вызывается из рабочего потока загрузки, поэтому читает своим соединением.
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            return {
+                (code, occurrence): (pos, row_hash % UINT64, shop)
+                for code, occurrence, pos, row_hash, shop in conn.execute(
+                    "SELECT code, occurrence, pos, row_hash, shop FROM shops"
+                )
+            }
+        finally:
+            conn.close()
+
+    def write(self, rows, removed, meta, replace=False):
+        """Записывает выгрузку одной транзакцией.
+
+        rows — (позиция или None для новой, ключ, хеш, ShopRecord, краткий, полный);
+        removed — позиции удалённых ММ; replace — заменить всё содержимое.
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                if replace:
+                    conn.execute("DELETE FROM shops")
+                    conn.execute("DELETE FROM shop_keys")
+                conn.executemany("DELETE FROM shops WHERE pos = ?", [(pos,) for pos in removed])
+                conn.executemany("DELETE FROM shop_keys WHERE pos = ?", [(pos,) for pos in removed])
+
+                columns = ("occurrence", "row_hash", *FIELDS, "name_norm", "n_words",
+                           "address_norm", "branch_norm", "tech_norm", "short_reply", "full_reply")
+                insert = (f"INSERT INTO shops (pos, {', '.join(columns)}) "
+                          f"VALUES ({', '.join('?' * (len(columns) + 1))})")
+                update = f"UPDATE shops SET {', '.join(f'{c} = ?' for c in columns)} WHERE pos = ?"
+
+                for pos, (_, occurrence), row_hash, rec, short, full in rows:
+                    name = " ".join(norm(rec.shop).split())
+                    values = (
+                        occurrence, to_signed(row_hash),
+                        *(getattr(rec, f) for f in FIELDS),
+                        name, len(name.split()), norm(rec.address),
+                        norm(rec.branch), norm(rec.tech), short, full,
+                    )
+                    if pos is not None and not replace:
+                        conn.execute(update, (*values, pos))
+                        conn.execute("DELETE FROM shop_keys WHERE pos = ?", (pos,))
+                    else:
+                        pos = conn.execute(insert, (pos, *values)).lastrowid
+                    conn.executemany(
+                        "INSERT INTO shop_keys (kind, key, pos) VALUES (?, ?, ?)",
+                        [("t", k, pos) for k in tech_keys(rec.tech)]
+                        + [("p", k, pos) for k in phone_keys(rec.tech_phone)],
+                    )
+
+                conn.execute("DELETE FROM name_lengths")
+                conn.execute(
+                    "INSERT INTO name_lengths SELECT n_words, COUNT(*) FROM shops "
+                    "WHERE n_words > 0 GROUP BY n_words"
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [(k, json.dumps(v, ensure_ascii=False)) for k, v in meta.items()],
+                )
+            self._generation += 1
+            self.fuzzy = None
+        finally:
+            conn.close()
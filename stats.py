@@ -0,0 +1,129 @@
+"""Счётчики и гистограммы задержек бота для /stats и Prometheus.
+
+Набор метрик задаётся при создании Metrics и дальше не меняется, поэтому
+HTTP-поток экспорта читает их без блокировок, пока бот их обновляет.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# верхние границы корзин, секунды
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # последняя — больше BUCKETS[-1]
+        self.total = 0.0
+        self.count = 0
+        self.maximum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.maximum = max(self.maximum, seconds)
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (линейно внутри корзины, не больше максимума)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return min(low + (high - low) * (rank - seen) / n, self.maximum)
+            seen += n
+        return self.maximum
+
+
+class Metrics:
+    """counters и histograms — {имя: описание}; имена без префикса"""
+
+    def __init__(self, prefix, counters, histograms):
+        self.prefix = prefix
+        self.started = time.time()
+        self.help = {**counters, **histograms}
+        self.counters = dict.fromkeys(counters, 0)
+        self.histograms = {name: Histogram() for name in histograms}
+
+    def inc(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def report(self):
+        """Текст для /stats"""
+        uptime = int(time.time() - self.started)
+        lines = [f"⏱ Аптайм: {uptime // 3600} ч {uptime % 3600 // 60} мин", ""]
+        for name, value in self.counters.items():
+            lines.append(f"{self.help[name]}: {value}")
+        lines.append("")
+        for name, h in self.histograms.items():
+            if not h.count:
+                lines.append(f"{self.help[name]}: нет данных")
+                continue
+            lines.append(
+                f"{self.help[name]}: {h.count} шт., "
+                f"сред. {h.total / h.count * 1000:.1f} мс, "
+                f"p50 {h.quantile(0.5) * 1000:.1f}, "
+                f"p90 {h.quantile(0.9) * 1000:.1f}, "
+                f"p99 {h.quantile(0.99) * 1000:.1f} мс"
+            )
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Текстовый формат экспозиции Prometheus"""
+        out = []
+        for name, value in self.counters.items():
+            metric = f"{self.prefix}_{name}_total"
+            out += [f"# HELP {metric} {self.help[name]}", f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, h in self.histograms.items():
+            metric = f"{self.prefix}_{name}_seconds"
+            out += [f"# HELP {metric} {self.help[name]}", f"# TYPE {metric} histogram"]
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                out.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            out.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            out.append(f"{metric}_sum {h.total}")
+            out.append(f"{metric}_count {h.count}")
+        return "\n".join(out) + "\n"
+
+
+def serve_prometheus(metrics, host, port):
+    """Отдаёт метрики на http://host:port/metrics из фонового потока"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
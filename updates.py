@@ -0,0 +1,48 @@
+"""Параллельная обработка обновлений Telegram с сохранением порядка внутри чата."""
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Разные чаты обслуживаются одновременно (не больше max_concurrent_updates),
+    а обновления одного чата — строго по очереди прихода.
+
+    Долгая /label или загрузка таблицы в одной группе не задерживает ответы в
+    других, а ответы внутри группы не обгоняют друг друга. Обновления без чата
+    (например, inline-запросы) идут без очереди.
+
+    Порядок держится на двух очередях: семафор PTB (asyncio.Semaphore с Python
+    3.11 пропускает ожидающих по порядку) передаёт обновления в do_process_update
+    в порядке прихода, а замок чата — тоже по порядку. Обновление, которое ждёт
+    свой чат, уже занимает место в семафоре, поэтому max_concurrent_updates
+    берётся с запасом: один шумный чат не должен занять все места.
+    """
+
+    __slots__ = ("_chats",)
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}   # chat_id -> [замок, сколько обновлений чата ждут или выполняются]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+
+        slot = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                await coroutine
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,133 @@
+"""Последние проверенные версии таблицы ММ для /versions и /rollback.
+
+Версия хранит готовую таблицу со всеми индексами поиска, поэтому откат —
+это замена одной ссылки, без повторного разбора Excel. Таблицы версий не
+меняются после сборки: новая выгрузка строит новую таблицу (update_table
+копирует списки и индексы), а старые продолжают отвечать как были.
+
+Проверенный файл каждой версии лежит на диске (state/versions/<номер>.xlsx),
+а список версий — в versions.json рядом, поэтому история переживает
+перезапуск. После перезапуска таблица есть только у текущей версии,
+остальные собираются из своего файла при откате.
+"""
+import contextlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+
+MANIFEST_FILE = "versions.json"
+
+
+@dataclass(slots=True)
+class DatasetVersion:
+    table: object | None   # ShopTable или shop_db; None — после перезапуска ещё не собрана
+    source_hash: str
+    updated_at: str
+    origin: str            # откуда версия: старт бота, загрузка файла
+    shops: int             # ММ в версии — для /versions без сборки таблицы
+    number: int = 0        # присваивает VersionStore.add
+    path: str | None = None   # проверенный data.xlsx версии; None — файлы версий не хранятся
+
+
+class VersionStore:
+    """Не больше keep последних версий; current — версия, которой отвечает бот"""
+
+    def __init__(self, keep, directory=None):
+        self.keep = max(1, keep)
+        self.directory = directory   # каталог файлов версий; None — только в памяти
+        self.versions = []     # по возрастанию номеров
+        self.current = None
+        self._last_number = 0
+
+    def load(self):
+        """Читает список версий, сохранённый до перезапуска; таблицы не собираются"""
+        if self.directory is None:
+            return
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE), encoding="utf-8") as f:
+                manifest = json.load(f)
+            entries = [
+                DatasetVersion(
+                    None, e["source_hash"], e["updated_at"], e["origin"], e["shops"],
+                    e["number"], self._path(e["number"]),
+                )
+                for e in manifest["versions"]
+            ]
+            last_number, current = manifest["last_number"], manifest["current"]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("⚠ Список версий таблицы повреждён:", e)
+            return
+
+        self.versions = [v for v in entries if os.path.exists(v.path)]
+        self._last_number = last_number
+        self.current = self.get(current)
+
+    def add(self, version, source=None):
+        """Запоминает новую версию и делает её текущей; самые старые вытесняются.
+
+        source — проверенный файл версии, он копируется в каталог версий.
+        """
+        self._last_number += 1
+        version.number = self._last_number
+        if self.directory is not None and source is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            version.path = self._path(version.number)
+            shutil.copyfile(source, version.path)
+
+        self.versions.append(version)
+        # текущая версия только что добавлена в конец, поэтому вытеснена не будет
+        evicted = self.versions[:-self.keep]
+        del self.versions[:-self.keep]
+        self.current = version
+        self.save()
+        for old in evicted:
+            if old.path is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(old.path)
+        return version
+
+    def get(self, number):
+        for version in self.versions:
+            if version.number == number:
+                return version
+        return None
+
+    def switch(self, version):
+        """Делает версию текущей; на диск список версий записывает save()"""
+        self.current = version
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"{number}.xlsx")
+
+    def save(self):
+        """Записывает список версий рядом с их файлами"""
+        if self.directory is None:
+            return
+        manifest = {
+            "last_number": self._last_number,
+            "current": self.current.number if self.current else None,
+            "versions": [
+                {
+                    "number": v.number,
+                    "source_hash": v.source_hash,
+                    "updated_at": v.updated_at,
+                    "origin": v.origin,
+                    "shops": v.shops,
+                }
+                for v in self.versions if v.path is not None
+            ],
+        }
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("⚠ Не удалось сохранить список версий таблицы:", e)
+
+    def __len__(self):
+        return len(self.versions)